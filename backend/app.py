@@ -1,16 +1,16 @@
 # app.py (已添加 update_role_position 处理器和广播优化)
 from datetime import datetime, timezone, timedelta
 import time
+import uuid
 from zoneinfo import ZoneInfo
 from fastapi import FastAPI, Query, Request, HTTPException, Body
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 import socketio
 import asyncio
-import math # 引入 math 用于计算距离
 
 # 导入时间管理器
 from autoUpdate import broadcast_time_updates
@@ -19,18 +19,29 @@ from time_manager import get_accelerated_time, set_time_acceleration, set_time_e
 # 从 memory_manager.py 导入记忆/时间/AI 逻辑
 from memory_manager import (
     add_memory, query_memory, list_roles, delete_collection,
-    update_time_memory, 
     get_role_activity,   # 获取角色活动状态函数
     CHINA_TZ, # 从 memory_manager 导入时区
     rest_manager, # 导入 rest_manager 实例
-    handle_npc_response # 导入处理 NPC 回复的函数
+    access_counter, flush_access_counts_periodically, # 访问计数批量写回
+    handle_npc_response, # 导入处理 NPC 回复的函数
+    resolve_action, # 解析移动指令的目标坐标
+    memory_writer # 记忆写入队列（按 tick 合并）
 )
 # 从 room.py 导入 Room 模型和房间管理函数
 from room import (
-    Room, get_room, add_role_to_room, remove_role_from_room, clear_room
+    Room, get_room, get_room_snapshot, add_role_to_room, remove_role_from_room, clear_room, find_roles_near,
+    room_store # 房间注册表（关闭时写盘）
 )
 from prompt_builder import generate_world_narrative
-from config import MIN_TOKEN_LEN_TO_STORE
+from consolidation import consolidate_periodically
+from embedding_service import embedding_service
+from ollama_client import llm_backend
+from llm_scheduler import llm_scheduler, Priority, LLMRequestCancelled
+from llm_cache import response_cache
+from token_counter import token_counter
+from metrics import registry as metrics_registry
+from retention import memory_archive, restore_memories, retain_periodically
+from config import MIN_TOKEN_LEN_TO_STORE, LISTENER_CONCURRENCY, HEARING_RADIUS_NEAR, HEARING_RADIUS_FAR
 from memory_manager import list_roles
 
 print("当前所有角色:", list_roles())
@@ -45,6 +56,9 @@ sio = socketio.AsyncServer(cors_allowed_origins="*", async_mode="asgi")
 # 全局变量
 # -------------------------
 time_update_task = None  # 用于存储时间更新任务
+access_flush_task = None  # 用于存储访问计数写回任务
+consolidation_task = None  # 用于存储后台记忆整理任务
+retention_task = None  # 用于存储记忆衰减/归档任务
 
 # -------------------------
 # Pydantic 模型
@@ -64,69 +78,140 @@ class DistanceChatPayload(BaseModel):
 # Socket.IO 辅助函数
 # -------------------------
 
-async def internal_distance_chat(room_name: str, req: DistanceChatPayload):
+async def internal_distance_chat(room_name: str, req: DistanceChatPayload, priority: Priority = Priority.USER):
     print(f"distance_chat 调用: 发送者={req.sender}, 消息={req.message}, 坐标=({req.x}, {req.y})")
     try:
         # 获取房间信息
         room = await asyncio.to_thread(get_room, room_name)
         
-        # 获取所有角色（除了发送者）
-        other_roles = [role for role in room.roles if role.name != req.sender]
+        roles_by_name = {role.name: role for role in room.roles if role.name != req.sender}
         results = {}
-        
-        for role in other_roles:
-            distance = math.sqrt((req.x - role.x) ** 2 + (req.y - role.y) ** 2)
-            
+        responders = []
+
+        # 听觉范围内的角色由空间哈希查出（平方距离比较，只访问附近格子）；
+        # 范围外的角色只有消息够长、需要留下"隐约听到"的记忆时才逐个处理
+        nearby = await asyncio.to_thread(find_roles_near, req.x, req.y, HEARING_RADIUS_FAR, room_name)
+        heard = {name: dist_sq for name, _, _, dist_sq in nearby if name in roles_by_name}
+        bands = sorted(((roles_by_name[name], dist_sq) for name, dist_sq in heard.items()), key=lambda b: b[1])
+        if len(req.message) >= MIN_TOKEN_LEN_TO_STORE:
+            bands.extend((role, None) for name, role in roles_by_name.items() if name not in heard)
+
+        near_sq = HEARING_RADIUS_NEAR ** 2
+        # 1. 先提交所有听觉记忆：同一 tick 内的写入由 memory_writer 合并为一次批量写入
+        for role, dist_sq in bands:
             # 检查角色是否在休息
             if rest_manager.is_resting(role.name):
                 rest_info = rest_manager.get_rest_info(role.name)
-                if distance <= 100:
+                if dist_sq is not None and dist_sq <= near_sq:
                     muffled_message = f"听到附近有声音，但正在{rest_info.get('rest_type', '休息')}无法回应"
-                    await asyncio.to_thread(add_memory, role.name, muffled_message, mtype="hearing")
-                elif distance <= 300 and len(req.message) >= MIN_TOKEN_LEN_TO_STORE:
+                    memory_writer.submit(role.name, muffled_message, "hearing")
+                elif dist_sq is not None and len(req.message) >= MIN_TOKEN_LEN_TO_STORE:
                     whisper_message = f"隐约听到有声音 ({req.message[:5]}...)"
-                    await asyncio.to_thread(add_memory, role.name, whisper_message, mtype="hearing")
+                    memory_writer.submit(role.name, whisper_message, "hearing")
                 continue
-            
-            # --- 重点修改区域: 距离 100 以内的 AI 处理 ---
-            if distance <= 100:
-               # 1. 记录听觉记忆
-                await asyncio.to_thread(add_memory, role.name, f" {req.sender} 对我说: {req.message}", mtype="hearing")
-                
-                # 2. 调用 AI 处理逻辑 (此处整合了新逻辑)
-                reply, action_status, cmd = await handle_npc_response(role, req.message, room)
-                
-                # 3. 如果发生了动作（移动），关键一步：通过 Socket 广播更新地图
-                if action_status:
-                    # 重新获取更新后的房间状态以确保坐标最新
-                    updated_room = await asyncio.to_thread(get_room, room_name)
-                    await sio.emit('room_update', updated_room.to_dict())
-                
-                # 4. 广播 AI 聊天消息
+
+            if dist_sq is not None and dist_sq <= near_sq:
+                memory_writer.submit(role.name, f" {req.sender} 对我说: {req.message}", "hearing")
+                responders.append(role)
+            elif dist_sq is not None:
+                muffled_message = f"听到附近有声音，但听不清内容 ({req.message[:10]}...)"
+                memory_writer.submit(role.name, muffled_message, "hearing")
+            else:
+                whisper_message = f"隐约听到有声音 ({req.message[:5]}...)"
+                memory_writer.submit(role.name, whisper_message, "hearing")
+
+        # 用户直接搭话时，被搭话 NPC 排队中的自主行动已经过时，取消掉
+        if priority == Priority.USER:
+            for role in responders:
+                llm_scheduler.cancel(role.name, Priority.AUTONOMOUS)
+
+        # 回复前确保听觉记忆已写入，回忆时能检索到刚听到的话
+        await memory_writer.drain()
+        
+        # --- 重点修改区域: 距离 100 以内的 AI 处理 ---
+        # 所有听者并发处理（记忆检索、提示词构建、生成互相重叠），谁先生成完谁先广播；
+        # 房间移动与聊天记忆在全部回复后按完成顺序统一写入
+        semaphore = asyncio.Semaphore(LISTENER_CONCURRENCY)
+
+        async def respond(role):
+            async with semaphore:
+                # 2. 调用 AI 处理逻辑，[SAY] 文本以 chat_message_delta 流式推送
+                message_id = str(uuid.uuid4())
+
+                streamed = False
+
+                async def emit_delta(delta):
+                    nonlocal streamed
+                    streamed = True
+                    await sio.emit('chat_message_delta', {
+                        "message_id": message_id,
+                        "sender": role.name,
+                        "delta": delta
+                    })
+
+                async def cancel_stream():
+                    # 已推送过片段却没有完整消息时，通知前端移除这条临时消息
+                    if streamed:
+                        await sio.emit('chat_message_cancel', {"message_id": message_id, "sender": role.name})
+
+                try:
+                    reply, action_status, response = await handle_npc_response(
+                        role, req.message, room, on_delta=emit_delta, priority=priority, apply_actions=False
+                    )
+                except LLMRequestCancelled as e:
+                    print(f"{role.name} 的回复已取消: {e}")
+                    await cancel_stream()
+                    return None
+                except Exception as e:
+                    print(f"NPC 回复失败: {role.name}: {e}")
+                    await cancel_stream()
+                    return None
+                return role, message_id, reply, action_status, response
+
+        tasks = [asyncio.create_task(respond(role)) for role in responders]
+        completed = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    result = await next_done
+                except Exception as e:
+                    print(f"NPC 回复失败: {e}")
+                    continue
+                if result is None:
+                    continue
+                role, message_id, reply, action_status, response = result
+
+                # 3. 广播 AI 聊天消息
                 display_msg = f"{reply} {f'（{action_status}）' if action_status else ''}"
                 await sio.emit('chat_message', {
+                    "message_id": message_id, # 与流式片段对应，前端用完整消息替换
                     "sender": role.name,
                     "message": display_msg,
                     "time": get_accelerated_time()["iso_format"], 
                     "color": "log-ai"
                 })
-                
-                # 5. 记录 AI 回复记忆
-                await asyncio.to_thread(add_memory, role.name, f"与 {req.sender} 聊天说: {req.message} -> {display_msg}", mtype="chat")
+                completed.append((role, response, display_msg))
                 results[role.name] = reply
-
-            # --- 剩余距离逻辑保持不变 ---
-            elif distance <= 300:
-                muffled_message = f"听到附近有声音，但听不清内容 ({req.message[:10]}...)"
-                await asyncio.to_thread(add_memory, role.name, muffled_message, mtype="hearing")
-            else:
-                if len(req.message) >= MIN_TOKEN_LEN_TO_STORE:
-                    whisper_message = f"隐约听到有声音 ({req.message[:5]}...)"
-                    await asyncio.to_thread(add_memory, role.name, whisper_message, mtype="hearing")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # 4. 如果发生了动作（移动），依次写入房间，再通过 Socket 广播一次更新后的地图
+        moved = False
+        for role, response, display_msg in completed:
+            move = resolve_action(room, response)
+            if move:
+                x, y, _ = move
+                await asyncio.to_thread(add_role_to_room, role.name, x, y, room.name)
+                moved = True
+            # 5. 记录 AI 回复记忆（后台合并写入）
+            memory_writer.submit(role.name, f"与 {req.sender} 聊天说: {req.message} -> {display_msg}", "chat")
+        if moved:
+            await broadcast_room_update(room_name)
         
         # 8. 记录发送者记忆并广播
         if len(req.message) >= MIN_TOKEN_LEN_TO_STORE:
-            await asyncio.to_thread(add_memory, req.sender, f"你说: {req.message}", mtype="chat")
+            memory_writer.submit(req.sender, f"你说: {req.message}", "chat")
 
         await sio.emit('chat_message', {
             "sender": req.sender,
@@ -136,8 +221,8 @@ async def internal_distance_chat(room_name: str, req: DistanceChatPayload):
         })
 
         # 2. 插入旁白并广播
-        # 必须使用 to_thread，因为 generate_world_narrative 内部调用了同步的 subprocess (Ollama)
-        # narrative = await asyncio.to_thread(generate_world_narrative, role.name)
+        # generate_world_narrative 通过 LLM 调度器以旁白优先级排队
+        # narrative = await generate_world_narrative(role.name)
 
         # if narrative:
         #     # 将旁白实时推送给前端 UI
@@ -160,31 +245,65 @@ async def internal_distance_chat(room_name: str, req: DistanceChatPayload):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"发送消息失败: {str(e)}")
 
+# 每个房间最近一次广播出去的状态 {"version", "layout_version", "roles": {角色名: 角色 dict}}，
+# 增量事件以它为基准；锁保证同一房间的增量按顺序发出
+_room_broadcasts: Dict[str, dict] = {}
+_room_broadcast_locks: Dict[str, asyncio.Lock] = {}
+
+def _collect_room_state(room_name: str):
+    """读取房间快照、版本号和每个角色（含活动状态）的 dict，整体在一个线程中完成"""
+    room, version, layout_version = get_room_snapshot(room_name)
+    roles = {}
+    for role in room.roles:
+        role_dict = role.model_dump()
+        role_dict["activity"] = get_role_activity(role.name)
+        roles[role.name] = role_dict
+    return room, version, layout_version, roles
+
+def _room_snapshot_payload(room: Room, version: int, roles: Dict[str, dict]) -> dict:
+    room_data = room.model_dump()
+    room_data["roles"] = list(roles.values())
+    room_data["version"] = version
+    return room_data
+
 async def broadcast_room_update(room_name: str = 'main', target_sid: Optional[str] = None):
-    """获取房间数据并广播给所有连接的客户端或特定客户端"""
+    """
+    把房间变化同步给客户端：布局不变时只广播变化的角色字段（room_delta，带 base_version/version），
+    首次广播或布局变化时广播完整快照（room_data_update）；指定 target_sid 时另给该客户端发送完整快照
+    """
     try:
-        # 1. 获取房间数据 (同步操作，放入线程)
-        room = await asyncio.to_thread(get_room, room_name)
-        
-        # 2. 获取角色的当前活动状态
-        roles_with_activity = []
-        for role in room.roles:
-            role_dict = role.dict()
-            # 获取活动状态 (同步操作，放入线程)
-            activity = await asyncio.to_thread(get_role_activity, role.name)
-            role_dict["activity"] = activity
-            roles_with_activity.append(role_dict)
-            
-        # 3. 构建完整的房间数据
-        room_data = room.dict()
-        room_data["roles"] = roles_with_activity # 替换为包含活动的列表
-
-        # 4. 发送给目标客户端或广播
-        if target_sid:
-            await sio.emit('room_data_update', room_data, room=target_sid)
-        else:
-            await sio.emit('room_data_update', room_data)
-            
+        lock = _room_broadcast_locks.setdefault(room_name, asyncio.Lock())
+        async with lock:
+            room, version, layout_version, roles = await asyncio.to_thread(_collect_room_state, room_name)
+            last = _room_broadcasts.get(room_name)
+            _room_broadcasts[room_name] = {"version": version, "layout_version": layout_version, "roles": roles}
+
+            if last is None or last["layout_version"] != layout_version:
+                await sio.emit('room_data_update', _room_snapshot_payload(room, version, roles))
+                return
+
+            changed = {}
+            for name, role_dict in roles.items():
+                before = last["roles"].get(name)
+                if before is None:
+                    changed[name] = role_dict
+                else:
+                    diff = {key: value for key, value in role_dict.items() if before.get(key) != value}
+                    if diff:
+                        changed[name] = diff
+            removed = [name for name in last["roles"] if name not in roles]
+            if changed or removed:
+                await sio.emit('room_delta', {
+                    "room_name": room_name,
+                    "base_version": last["version"],
+                    "version": version,
+                    "roles": changed,
+                    "removed": removed
+                })
+
+            if target_sid:
+                await sio.emit('room_data_update', _room_snapshot_payload(room, version, roles), room=target_sid)
+
     except Exception as e:
         print(f"广播房间更新失败: {e}")
 
@@ -195,7 +314,7 @@ async def broadcast_room_update(room_name: str = 'main', target_sid: Optional[st
 @sio.on('request_initial_data')
 async def request_initial_data(sid, data):
     """
-    客户端连接时请求房间布局和角色的初始数据 (只发给请求的客户端)
+    客户端连接（或检测到增量版本不连续）时请求完整快照 (只发给请求的客户端)
     """
     room_name = data.get('room_name', 'main')
     print(f"SocketIO: {sid} 请求房间 {room_name} 初始数据")
@@ -216,7 +335,7 @@ async def update_user_position(sid, data):
         # add_role_to_room 是同步的，需要在线程中运行
         await asyncio.to_thread(add_role_to_room, role_name, x, y, room_name, avatar)
         
-        # 广播更新后的房间数据给所有连接的客户端
+        # 向所有客户端广播变化的角色字段（room_delta）
         await broadcast_room_update(room_name, None) 
 
 @sio.on('update_role_position') # <--- 新增的 AI 角色位置更新处理器
@@ -235,7 +354,7 @@ async def update_role_position(sid, data):
         # 注意：这里没有提供 avatar，但 add_role_to_room 应该能处理更新现有角色的逻辑
         await asyncio.to_thread(add_role_to_room, role_name, x, y, room_name)
         
-        # 广播更新后的房间数据给所有连接的客户端
+        # 向所有客户端广播变化的角色字段（room_delta）
         await broadcast_room_update(room_name, None)
 
 @sio.on('clear_room')
@@ -300,13 +419,7 @@ async def add_role_handler(sid, data):
             add_memory, role_name, system_prompt, mtype="system"
         )
 
-        # 3. 初始化时间记忆（使用统一时间管理器）
-        time_info = get_accelerated_time()
-        await asyncio.to_thread(
-            update_time_memory, role_name, time_info
-        )
-
-    # 4. 广播房间更新
+    # 3. 广播房间更新
     await broadcast_room_update(room_name, None)
 
     print(f"SocketIO: 角色 {role_name} 已添加到房间 {room_name}")
@@ -355,7 +468,7 @@ async def memory_viewer_page(request: Request):
     return templates.TemplateResponse("memory_viewer.html", {"request": request})
 @app.post("/distance_chat/{room_name}")
 async def distance_chat(room_name: str, req: DistanceChatPayload):
-    internal_distance_chat(room_name, req)
+    return await internal_distance_chat(room_name, req)
    
 @app.get("/api/memory/roles")
 async def get_memory_roles():
@@ -369,7 +482,7 @@ async def get_role_memories(role: str, search: str = Query(None)):
     # 調用 memory_manager.py 的 query_memory
     # 注意：原本的 query_memory 返回的是處理過的智能回憶，
     # 這裡我們稍微封裝一下獲取原始數據
-    mems = await asyncio.to_thread(query_memory, role, search or "")
+    mems = await asyncio.to_thread(query_memory, role, search or "", mode="scan")
     
     # 格式化輸出給前端
     formatted_mems = []
@@ -384,6 +497,36 @@ async def get_role_memories(role: str, search: str = Query(None)):
         })
     return {"role": role, "memories": formatted_mems}
 
+@app.get("/api/memory/archive/{role}")
+async def get_archived_memories(role: str):
+    """獲取角色冷歸檔中的記憶列表"""
+    entries = await asyncio.to_thread(memory_archive.load, role)
+    return {"role": role, "memories": [{
+        "id": e["id"],
+        "content": e["content"],
+        "type": e["metadata"].get("type", "unknown"),
+        "importance": e["metadata"].get("importance", 1.0),
+        "access_count": e["metadata"].get("access_count", 0),
+        "created_at": e["metadata"].get("created_at"),
+        "archived_at": e.get("archived_at")
+    } for e in entries]}
+
+@app.post("/api/memory/archive/{role}/restore")
+async def restore_archived_memories(role: str, ids: List[str] = Body(..., embed=True)):
+    """從冷歸檔恢復指定記憶到熱索引"""
+    restored = await asyncio.to_thread(restore_memories, role, ids)
+    return {"status": "success", "restored": restored}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 文本格式的 LLM / 记忆检索 / 房间读写指标"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/llm/cache")
+async def get_llm_cache_stats():
+    """LLM 回复缓存的命中统计"""
+    return response_cache.stats()
+
 @app.delete("/api/memory/clear/{role}")
 async def clear_role_memory(role: str):
     """手動清空角色記憶"""
@@ -420,22 +563,42 @@ async def disconnect(sid):
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化操作"""
-    global time_update_task
+    global time_update_task, access_flush_task, consolidation_task, retention_task
+    # 预先加载嵌入模型（只加载一次）
+    try:
+        await asyncio.to_thread(embedding_service.load)
+    except Exception as e:
+        print(f"嵌入模型加载失败: {e}")
+    # 预先加载提示词计数用的分词器（失败时自动改用估算）
+    await asyncio.to_thread(token_counter.load)
     # 启动时间更新任务
     time_update_task = asyncio.create_task(broadcast_time_updates(sio))
     print("Time update task started")
+    # 启动访问计数定时写回任务
+    access_flush_task = asyncio.create_task(flush_access_counts_periodically())
+    # 启动后台记忆整理任务
+    consolidation_task = asyncio.create_task(consolidate_periodically())
+    # 启动记忆衰减/归档任务
+    retention_task = asyncio.create_task(retain_periodically())
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时的清理操作"""
-    global time_update_task
-    if time_update_task and not time_update_task.done():
-        time_update_task.cancel()
-        try:
-            await time_update_task
-        except asyncio.CancelledError:
-            pass
+    global time_update_task, access_flush_task, consolidation_task, retention_task
+    for task in (time_update_task, access_flush_task, consolidation_task, retention_task):
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
     print("Time update task stopped")
+    # 关闭前等待排队中的记忆写入，并写回尚未持久化的访问计数
+    await memory_writer.drain()
+    await asyncio.to_thread(access_counter.flush)
+    # 写入尚未落盘的房间变化
+    await asyncio.to_thread(room_store.flush_all)
+    await llm_backend.aclose()
 
 # -------------------------
 # 挂载静态文件和模板
@@ -4,34 +4,22 @@ import random
 import math  # 导入用于计算距离
 
 
-from util import process_message
 from prompt_builder import generate_world_narrative
 from memory_manager import (
     add_memory,
     list_roles, 
     update_rest_states, 
-    update_time_memory, 
     handle_npc_response,
     rest_manager
 )
 from time_manager import get_accelerated_time
 from room import get_room
+from llm_scheduler import Priority, LLMRequestCancelled
 
 def calculate_distance(p1, p2):
     """计算两个坐标点之间的距离"""
     return math.sqrt((p1.x - p2.x)**2 + (p1.y - p2.y)**2)
 
-async def update_all_roles_time_memory(time_info: dict):
-    """为所有角色更新时间记忆（每10分钟调用）"""
-    try:
-        virtual_time = time_info["virtual_time"]
-        roles = list_roles()
-        for role in roles:
-            await asyncio.to_thread(update_time_memory, role, time_info)
-        print(f"为 {len(roles)} 个角色更新时间记忆: {virtual_time.isoformat()}")
-    except Exception as e:
-        print(f"更新角色时间记忆失败: {e}")
-
 async def broadcast_time_updates(sio):
     """定期广播时间并触发 NPC 自主决策（含主动找附近的人聊天）"""
     last_minute_check = None
@@ -46,7 +34,6 @@ async def broadcast_time_updates(sio):
             check_minute_interval = current_minute // 10 
             
             if last_minute_check != check_minute_interval:
-                await update_all_roles_time_memory(time_info)
                 await asyncio.to_thread(update_rest_states)
                 
                 roles_names = list_roles()
@@ -64,14 +51,20 @@ async def broadcast_time_updates(sio):
                         print(f"--- [NPC自主行動] {role_name} 正在思考... ---")
                         
                         # 調用 AI 獲取回覆和指令
-                        reply, action_status, cmd = await handle_npc_response(
-                            role=role_obj,
-                            user_message="", # 自主行動時 user_message 為空
-                            room=room_obj
-                        )
+                        try:
+                            reply, action_status, response = await handle_npc_response(
+                                role=role_obj,
+                                user_message="", # 自主行動時 user_message 為空
+                                room=room_obj,
+                                priority=Priority.AUTONOMOUS
+                            )
+                        except LLMRequestCancelled as e:
+                            # 用户刚和该角色搭话，或排队超时
+                            print(f"--- [NPC自主行動] {role_name} 已取消: {e} ---")
+                            continue
                         
-                        # 使用您之前定義好的 Python 版 process_message 清洗文本
-                        reply = process_message(reply)
+                        # 解析結果已去掉思考和指令，說給別人聽的話再去掉括號內的神態動作
+                        reply = response.speech
                         
                         if reply:
                             # 1. 為了防止循環導入，在函數內部 import
@@ -87,7 +80,8 @@ async def broadcast_time_updates(sio):
                             
                             await app.internal_distance_chat(
                                 room_name='main',
-                                req=payload
+                                req=payload,
+                                priority=Priority.NPC
                             )
                             
                             # --- 🔥 核心修改：一旦有人觸發並成功發言，立刻退出循環 ---
@@ -99,7 +93,7 @@ async def broadcast_time_updates(sio):
                 # if random.random() < 0.2: 
                 #     for role_name in roles_names:
                 #         if role_name.lower() == 'user': continue
-                #         narrative = await asyncio.to_thread(generate_world_narrative, role_name)
+                #         narrative = await generate_world_narrative(role_name)
                 #         if narrative:
                 #             await sio.emit('chat_message', {
                 #                 "sender": "世界线",
@@ -1,9 +1,80 @@
 OLLAMA_MODEL = "qwen3:14b"
+# 本地 Ollama HTTP API
+OLLAMA_BASE_URL = "http://127.0.0.1:11434"
+OLLAMA_KEEP_ALIVE = "30m"      # 模型在显存/内存中常驻的时长
+OLLAMA_TIMEOUT = 300           # 单次生成超时（秒）
+OLLAMA_MAX_RETRIES = 2         # 连接错误/5xx 的重试次数
+OLLAMA_MAX_CONNECTIONS = 4     # 连接池大小
+# LLM 后端："ollama" 真实模型；"fake" 模拟延迟与 token 速率的假模型（压测/CI）；
+# "record" 调用 ollama 并把 prompt -> response 录制到 LLM_RECORD_PATH；"replay" 按录制内容回放
+LLM_BACKEND = "ollama"
+FAKE_LLM_LATENCY = 0.5         # 假模型首个 token 前的等待（秒）
+FAKE_LLM_TOKENS_PER_SEC = 20   # 假模型的输出速率
+LLM_RECORD_PATH = "llm_recordings.jsonl"
+LLM_REPLAY_STRICT = True       # 回放未命中时抛出异常；False 时按录制顺序返回下一条记录
+STREAM_REPLIES = True          # NPC 回复以 chat_message_delta 事件流式推送给前端
+LISTENER_CONCURRENCY = 4       # 同一句话的多个听者最多同时处理几个
+HEARING_RADIUS_NEAR = 100      # 听得清并会回应的距离
+HEARING_RADIUS_FAR = 300       # 听得到但听不清的距离；更远只留下"隐约听到"
+PERCEPTION_MAX_ROLES = 12      # 环境感知中最多列出的周边人物，超出时只列感知半径内最近的几位
+PERCEPTION_RADIUS = 500
+# LLM 回复缓存（自主行动、旁白等非用户对话的调用）：TTL 为真实秒数，提示词中的时间按桶取整
+LLM_CACHE_ENABLED = True
+LLM_CACHE_TTL = 600
+LLM_CACHE_MAX_ENTRIES = 256
+LLM_CACHE_TIME_BUCKET_MINUTES = 30
+# 提示词排列方式："cache" 按稳定性排列以复用 KV 缓存前缀，"classic" 为原排列。
+# Ollama 会为每个并行槽位保留上一次的 KV 缓存并复用最长公共前缀，
+# 启动 ollama 时设置 OLLAMA_NUM_PARALLEL >= 活跃 NPC 数，即可让每个角色各自保有一个槽位
+PROMPT_LAYOUT = "cache"
+# NPC 提示词的 token 预算（None 不限），以及计数用的本地分词器（tokenizer.json 路径或 HuggingFace 模型名）
+PROMPT_TOKEN_BUDGET = 3072
+PROMPT_TOKENIZER = "Qwen/Qwen3-14B"
+# LLM 请求调度：同时生成的请求数（单卡/CPU 上 Ollama 本身串行执行，设为 1 让高优先级请求插队）
+LLM_MAX_CONCURRENCY = 1
+# 各优先级请求从提交开始的截止时间（秒），None 表示不限
+LLM_DEADLINES = {
+    "user": None,
+    "npc": 300,
+    "autonomous": 120,
+    "narrative": 120,
+    "background": 600,
+}
 CHROMA_DB_DIR = "memory_db"
 EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+# 嵌入请求的微批：凑满批大小或等待超时（毫秒）即提交一次前向计算
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_WAIT_MS = 10
 MAX_MEMORY_TO_FEED = 8
 MIN_TOKEN_LEN_TO_STORE = 6
 
+# 记忆检索模式："vector" 按相似度 top-k 检索；"scan" 为旧的全量扫描（记忆管理页面使用）
+MEMORY_RETRIEVAL_MODE = "vector"
+# 最近记忆窗口（虚拟分钟）以及窗口内最多取回的条数
+RECENT_MEMORY_WINDOW_MINUTES = 120
+RECENT_MEMORY_COUNT = 8
+# 访问计数批量写回 Chroma 的间隔（真实秒）
+ACCESS_COUNT_FLUSH_INTERVAL = 30
+# 热记忆层最多常驻的角色数（LRU 淘汰）
+MEMORY_TIER_MAX_ROLES = 32
+
+# 记忆整理：把旧的情景记忆按虚拟时间窗口聚类，交给本地模型压缩为一条 summary 记忆
+CONSOLIDATION_ENABLED = True
+CONSOLIDATION_INTERVAL = 300            # 两次整理之间的间隔（真实秒）
+CONSOLIDATION_TARGET_SIZE = 500         # 每个角色的目标记忆条数，超过才整理
+CONSOLIDATION_MIN_AGE_MINUTES = 180     # 只整理早于该时长的记忆（虚拟分钟）
+CONSOLIDATION_WINDOW_MINUTES = 60       # 聚类的虚拟时间窗口
+CONSOLIDATION_MAX_CLUSTERS_PER_PASS = 5 # 每个角色每轮最多整理的窗口数
+CONSOLIDATION_TYPES = ["hearing", "chat", "response"]
+
+# 记忆保留策略：重要性按虚拟时间半衰期衰减（访问即强化），低价值记忆移入冷归档
+RETENTION_ENABLED = True
+RETENTION_INTERVAL = 600             # 两次检查之间的间隔（真实秒）
+RETENTION_HALF_LIFE_HOURS = 72       # 重要性半衰期（虚拟小时）
+RETENTION_MIN_VALUE = 0.5            # 衰减后价值低于该值的记忆会被归档
+RETENTION_MAX_HOT = 2000             # 每个角色热索引中最多保留的记忆条数
+MEMORY_ARCHIVE_DIR = "memory_archive"
+
 # 在 config.py 中修改
 from datetime import datetime, timezone, timedelta
 
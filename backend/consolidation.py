@@ -0,0 +1,136 @@
+# consolidation.py
+# 后台记忆整理：把旧的 hearing/chat/response 记忆按虚拟时间窗口聚类，
+# 交给本地模型压缩为一条 summary 记忆，并删除原始片段
+import asyncio
+from datetime import datetime
+from typing import Dict, List
+import numpy as np
+
+from config import (
+    CHINA_TZ,
+    CONSOLIDATION_ENABLED, CONSOLIDATION_INTERVAL, CONSOLIDATION_TARGET_SIZE,
+    CONSOLIDATION_MIN_AGE_MINUTES, CONSOLIDATION_WINDOW_MINUTES,
+    CONSOLIDATION_MAX_CLUSTERS_PER_PASS, CONSOLIDATION_TYPES
+)
+from memory_manager import memory_tier, add_memory, delete_memories, list_roles
+from memory_columns import _to_epoch
+from ollama_client import run_ollama
+from llm_scheduler import Priority, LLMRequestCancelled
+from time_manager import get_accelerated_time
+
+
+def find_clusters(role: str, target_size: int = CONSOLIDATION_TARGET_SIZE) -> List[List[Dict]]:
+    """
+    找出需要整理的记忆簇：角色记忆数超过 target_size 时，
+    从最旧的时间窗口开始，直到整理后能回到目标以内或达到每轮上限。
+    """
+    cols = memory_tier.get(role)
+    if cols is None:
+        return []
+
+    now_ts = get_accelerated_time()["virtual_time"].timestamp()
+    window_seconds = CONSOLIDATION_WINDOW_MINUTES * 60
+
+    with cols.lock:
+        excess = len(cols) - target_size
+        if excess <= 0:
+            return []
+
+        mask = (cols.type_mask(CONSOLIDATION_TYPES)
+                & (cols.created > 0)
+                & (cols.created <= now_ts - CONSOLIDATION_MIN_AGE_MINUTES * 60))
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return []
+
+        # 按 (窗口, 时间) 排序后按窗口切分
+        windows = (cols.created[rows] // window_seconds).astype(np.int64)
+        order = np.lexsort((cols.created[rows], windows))
+        rows, windows = rows[order], windows[order]
+        _, starts = np.unique(windows, return_index=True)
+
+        clusters = []
+        for group in np.split(rows, starts[1:]):
+            if len(group) < 2:
+                continue
+            clusters.append([cols.mems[row] for row in group])
+            excess -= len(group) - 1
+            if excess <= 0 or len(clusters) >= CONSOLIDATION_MAX_CLUSTERS_PER_PASS:
+                break
+        return clusters
+
+
+def _cluster_span(cluster: List[Dict]):
+    # 与聚类使用同一个时间来源：旧记忆只有 created_at
+    first = datetime.fromtimestamp(_to_epoch(cluster[0]["metadata"]), CHINA_TZ)
+    last = datetime.fromtimestamp(_to_epoch(cluster[-1]["metadata"]), CHINA_TZ)
+    return first, last
+
+
+async def summarize_cluster(role: str, cluster: List[Dict]) -> str:
+    """调用本地模型把一个时间窗口内的零碎经历压缩为第一人称摘要"""
+    first, last = _cluster_span(cluster)
+    fragments = "\n".join(f"- {mem['content']}" for mem in cluster)
+
+    prompt = f"""
+    ### 任务
+    你是 {role} 的记忆整理者。下面是 {role} 在 {first.strftime('%m-%d %H:%M')} 到 {last.strftime('%H:%M')} 之间的零碎经历（听到的话、聊天记录）。
+    请把它们压缩成一段第一人称的回忆摘要。
+
+    ### 经历片段
+    {fragments}
+
+    ### 要求
+    1. 保留人物、关键事件、约定和情绪变化，省略寒暄与重复内容。
+    2. 字数控制在 100 字以内，只输出摘要本身。
+    """
+    return (await run_ollama(prompt, Priority.BACKGROUND, role=role, cache=False, site="consolidation")).strip()
+
+
+def commit_summary(role: str, cluster: List[Dict], summary: str) -> int:
+    """写入摘要记忆并删除原始片段，返回删除的条数"""
+    first, last = _cluster_span(cluster)
+    content = f"【{first.strftime('%m-%d %H:%M')}-{last.strftime('%H:%M')} 的回忆】{summary}"
+    # 摘要沿用簇内最后一条记忆的虚拟时间，保持时间线顺序
+    if not add_memory(role, content, mtype="summary", virtual_time=last):
+        # 摘要写入失败时不删除原始片段
+        return 0
+    if delete_memories(role, [mem["id"] for mem in cluster]):
+        return len(cluster)
+    return 0
+
+
+async def consolidate_role(role: str, target_size: int = CONSOLIDATION_TARGET_SIZE) -> int:
+    """整理单个角色的记忆，返回被压缩掉的原始记忆条数"""
+    clusters = await asyncio.to_thread(find_clusters, role, target_size)
+    removed = 0
+    for cluster in clusters:
+        try:
+            summary = await summarize_cluster(role, cluster)
+        except LLMRequestCancelled as e:
+            # 前台请求繁忙，本轮到此为止
+            print(f"记忆整理 - 角色 {role}: {e}")
+            break
+        if not summary:
+            # 模型调用失败时保留原始记忆，下一轮再试
+            continue
+        removed += await asyncio.to_thread(commit_summary, role, cluster, summary)
+        # 低优先级：每个簇之间让出事件循环
+        await asyncio.sleep(1)
+    if removed:
+        print(f"记忆整理 - 角色 {role}: {len(clusters)} 个时间窗口，压缩 {removed} 条记忆")
+    return removed
+
+
+async def consolidate_periodically(interval: float = CONSOLIDATION_INTERVAL):
+    """后台定时整理所有角色的记忆"""
+    while True:
+        await asyncio.sleep(interval)
+        if not CONSOLIDATION_ENABLED:
+            continue
+        try:
+            roles = await asyncio.to_thread(list_roles)
+            for role in roles:
+                await consolidate_role(role)
+        except Exception as e:
+            print(f"记忆整理失败: {e}")
@@ -0,0 +1,84 @@
+# embedding_service.py
+# 统一的嵌入服务：启动时加载一次 EMBED_MODEL_NAME 模型，
+# 各线程提交的嵌入请求在队列中按数量或等待时间凑成小批次，一次前向计算
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+from config import EMBED_MODEL_NAME, EMBED_BATCH_SIZE, EMBED_BATCH_WAIT_MS
+
+
+def _load_model(model_name: str):
+    """加载嵌入模型，返回可调用对象 model(texts) -> vectors"""
+    from chromadb.utils import embedding_functions
+    if model_name == "all-MiniLM-L6-v2":
+        # Chroma 自带该模型的 ONNX 版本（也是 Chroma 的默认模型），无需 torch
+        return embedding_functions.ONNXMiniLM_L6_V2()
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
+
+
+class EmbeddingService:
+    def __init__(self, model_name: str = EMBED_MODEL_NAME,
+                 batch_size: int = EMBED_BATCH_SIZE, max_wait_ms: float = EMBED_BATCH_WAIT_MS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.model = None
+        self.queue = queue.Queue()  # [(texts, Future)]
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """加载模型并启动批处理线程（只执行一次）"""
+        with self.lock:
+            if self.model is None:
+                model = _load_model(self.model_name)
+                model(["warmup"])  # 预热，确保模型文件已就绪
+                self.model = model
+                print(f"嵌入模型已加载: {self.model_name}")
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self.worker.start()
+
+    def embed(self, texts: List[str]) -> list:
+        """提交一组文本并等待其嵌入结果（在工作线程中调用）"""
+        if not texts:
+            return []
+        self.load()
+        future = Future()
+        self.queue.put((list(texts), future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            # 凑批：达到批大小或等待超时即提交
+            while count < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[0])
+            self._process(batch)
+
+    def _process(self, batch):
+        # 同一句话传给多个听者时只计算一次
+        unique = list(dict.fromkeys(text for texts, _ in batch for text in texts))
+        try:
+            vectors = self.model(unique)
+            lookup = dict(zip(unique, vectors))
+            for texts, future in batch:
+                future.set_result([lookup[text] for text in texts])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+
+embedding_service = EmbeddingService()
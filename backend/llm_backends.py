@@ -0,0 +1,166 @@
+# llm_backends.py
+# 可替换的 LLM 后端（与 OllamaClient 接口一致：generate / generate_stream / aclose）：
+# FakeBackend 按配置的延迟和 token 速率返回符合协议的输出，用于无模型的压测；
+# RecordingBackend / ReplayBackend 把 prompt -> response 记录到 JSONL 并按确定顺序回放，用于回归测试
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+from collections import deque
+from typing import AsyncIterator, Iterator
+
+from llm_cache import normalize_prompt
+from metrics import llm_call_stats
+
+
+def prompt_key(prompt: str) -> str:
+    """录制/回放用的键：抹去提示词中的虚拟时钟（随真实时间漂移）并合并空白"""
+    return hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()
+
+
+def _chunks(text: str, size: int) -> Iterator[str]:
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class FakeBackend:
+    """
+    模拟本地模型：首个 token 前等待 latency 秒（模拟预填充），之后按 tokens_per_sec 逐 token 输出。
+    同一个 prompt 总是得到同一个回复
+    """
+    SAY_LINES = ["嗯，我知道了。", "(伸了個懶腰) 現在做點什麼好呢？", "(點點頭) 好啊，我們一起去吧。",
+                 "今天天氣不錯呢。", "(打哈欠) 有點累了。"]
+    NARRATIVE_LINES = ["[旁白] 屋內很安靜，只有時鐘的滴答聲。", "[旁白] 窗外的光線慢慢暗了下來。"]
+
+    def __init__(self, latency: float = 0.5, tokens_per_sec: float = 20.0, move_probability: float = 0.2):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.move_probability = move_probability
+
+    def _response(self, prompt: str) -> str:
+        rng = random.Random(prompt_key(prompt))
+        if "[SAY]" not in prompt:
+            # 旁白、记忆整理等不走回复协议的调用
+            return rng.choice(self.NARRATIVE_LINES)
+        action, target = "none", ""
+        targets = []
+        for line in prompt.splitlines():
+            if "🪑" in line:
+                # 兩種排列分別為 "🪑 床、門" 和 "🪑 **周邊設施**：床、門"
+                targets = [t.strip() for t in line.split("：")[-1].replace("🪑", "").strip(" *").split("、")]
+                targets = [t for t in targets if t and t != "無"]
+                break
+        if targets and rng.random() < self.move_probability:
+            action, target = "talk_and_move", rng.choice(targets)
+        say = rng.choice(self.SAY_LINES)
+        cmd = json.dumps({"action": action, "target": target}, ensure_ascii=False)
+        return f"[THOUGHT] 看看周圍的情況再決定。\n[SAY] {say}\nJSON_START {cmd} JSON_END"
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+    def _record_stats(self):
+        stats = llm_call_stats.get()
+        if stats is not None:
+            stats["ttft"] = self.latency
+
+    async def generate(self, prompt: str) -> str:
+        response = self._response(prompt)
+        self._record_stats()
+        await asyncio.sleep(self.latency + len(response) * self._token_delay())
+        return response
+
+    async def generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        await asyncio.sleep(self.latency)
+        for token in self._response(prompt):
+            await asyncio.sleep(self._token_delay())
+            yield token
+
+    async def aclose(self):
+        pass
+
+
+class RecordingBackend:
+    """包装真实后端，把每次调用的 prompt -> response 追加写入 JSONL"""
+    def __init__(self, inner, path: str):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _record(self, prompt: str, response: str, stream: bool):
+        line = json.dumps({"key": prompt_key(prompt), "stream": stream, "prompt": prompt, "response": response},
+                          ensure_ascii=False)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    async def generate(self, prompt: str) -> str:
+        response = await self.inner.generate(prompt)
+        await asyncio.to_thread(self._record, prompt, response, False)
+        return response
+
+    async def generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        chunks = []
+        async for chunk in self.inner.generate_stream(prompt):
+            chunks.append(chunk)
+            yield chunk
+        await asyncio.to_thread(self._record, prompt, "".join(chunks), True)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+class ReplayMiss(LookupError):
+    """回放时找不到该 prompt 的录制记录"""
+
+
+class ReplayBackend:
+    """
+    按 prompt 回放 RecordingBackend 的记录，不调用模型。同一个 prompt 录了多次时按录制顺序依次返回，
+    用完后重复最后一条。没有匹配的记录时默认（strict）抛出 ReplayMiss；
+    strict=False 时打印警告并按录制顺序返回下一条记录。未命中次数记在 misses 中，供测试断言为 0
+    """
+    def __init__(self, path: str, chunk_size: int = 8, strict: bool = True):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.strict = strict
+        self.responses = {}  # key -> deque[response]
+        self.recorded = []   # 按录制顺序的全部回复，未命中时依次取用
+        self.cursor = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        # 键按当前的规范化规则从原始 prompt 重新计算
+                        self.responses.setdefault(prompt_key(entry["prompt"]), deque()).append(entry["response"])
+                        self.recorded.append(entry["response"])
+        print(f"LLM 回放: 从 {path} 载入 {len(self.recorded)} 条记录")
+
+    def _next(self, prompt: str) -> str:
+        key = prompt_key(prompt)
+        with self.lock:
+            queue = self.responses.get(key)
+            if queue:
+                return queue.popleft() if len(queue) > 1 else queue[0]
+            self.misses += 1
+            if self.strict or not self.recorded:
+                raise ReplayMiss(f"LLM 回放未命中 ({key[:12]})：{self.path} 中没有该 prompt 的记录")
+            response = self.recorded[self.cursor % len(self.recorded)]
+            self.cursor += 1
+            print(f"警告: LLM 回放未命中 ({key[:12]})，第 {self.misses} 次：按录制顺序返回第 {self.cursor} 条记录")
+            return response
+
+    async def generate(self, prompt: str) -> str:
+        return self._next(prompt)
+
+    async def generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        for chunk in _chunks(self._next(prompt), self.chunk_size):
+            yield chunk
+
+    async def aclose(self):
+        pass
@@ -0,0 +1,91 @@
+# llm_cache.py
+# LLM 回复缓存：以规范化后的提示词哈希为键（时间按桶取整），LRU + TTL 淘汰。
+# 空闲 NPC 的自主行动、旁白等提示词经常完全相同，命中时直接复用上一次的生成结果
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import (
+    OLLAMA_MODEL, LLM_CACHE_ENABLED, LLM_CACHE_TTL,
+    LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TIME_BUCKET_MINUTES
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_CLOCK_RE = re.compile(r"\b(\d{1,2}):(\d{2})\b")
+
+
+def normalize_prompt(prompt: str, bucket_minutes: Optional[int] = None) -> str:
+    """规范化提示词：时间取整到 bucket_minutes 分钟的桶（None 时整体抹去），合并空白"""
+    if bucket_minutes is None:
+        normalized = _CLOCK_RE.sub("--:--", prompt)
+    else:
+        def bucket_clock(match) -> str:
+            minutes = int(match.group(1)) * 60 + int(match.group(2))
+            minutes -= minutes % bucket_minutes
+            return f"{minutes // 60:02d}:{minutes % 60:02d}"
+        normalized = _CLOCK_RE.sub(bucket_clock, prompt)
+    return _WHITESPACE_RE.sub(" ", normalized).strip()
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = LLM_CACHE_MAX_ENTRIES, ttl: float = LLM_CACHE_TTL,
+                 bucket_minutes: int = LLM_CACHE_TIME_BUCKET_MINUTES, enabled: bool = LLM_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bucket_minutes = max(1, bucket_minutes)
+        self.enabled = enabled
+        self.entries = OrderedDict()  # key -> (expires_at, response)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, prompt: str) -> str:
+        """规范化提示词：时间取整到桶，合并空白"""
+        normalized = normalize_prompt(prompt, self.bucket_minutes)
+        return hashlib.sha256(f"{OLLAMA_MODEL}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, prompt: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        key = self.key(prompt)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, prompt: str, response: str):
+        # 空回复通常是调用失败，不缓存
+        if not self.enabled or not response:
+            return
+        key = self.key(prompt)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+response_cache = ResponseCache()
@@ -0,0 +1,121 @@
+# llm_scheduler.py
+# 统一的 LLM 请求调度：按优先级排队（用户对话 > NPC 间对话 > 自主行动 > 旁白 > 后台整理），
+# 限制同时生成的数量，支持截止时间和取消排队中的过期请求
+import asyncio
+import heapq
+import itertools
+from enum import IntEnum
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from config import LLM_MAX_CONCURRENCY, LLM_DEADLINES
+from metrics import LLM_QUEUE_WAIT, LLM_DROPPED
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    USER = 0        # 用户直接对 NPC 说话
+    NPC = 1         # NPC 之间的对话
+    AUTONOMOUS = 2  # NPC 自主行动
+    NARRATIVE = 3   # 神视角旁白
+    BACKGROUND = 4  # 记忆整理等后台任务
+
+
+class LLMRequestCancelled(Exception):
+    """排队中的请求被取消"""
+
+
+class LLMRequestExpired(LLMRequestCancelled):
+    """请求超过截止时间"""
+
+
+class _Ticket:
+    def __init__(self, priority: Priority, role: Optional[str], deadline: Optional[float], future: asyncio.Future):
+        self.priority = priority
+        self.role = role
+        self.deadline = deadline
+        self.future = future
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiting = []  # 堆：(priority, seq, ticket)
+        self.seq = itertools.count()
+
+    def _default_deadline(self, priority: Priority) -> Optional[float]:
+        timeout = LLM_DEADLINES.get(priority.name.lower())
+        return None if timeout is None else asyncio.get_running_loop().time() + timeout
+
+    def _grant_next(self):
+        loop_time = asyncio.get_running_loop().time()
+        while self.active < self.max_concurrency and self.waiting:
+            _, _, ticket = heapq.heappop(self.waiting)
+            if ticket.future.done():
+                continue  # 已取消
+            if ticket.deadline is not None and loop_time >= ticket.deadline:
+                ticket.future.set_exception(LLMRequestExpired(f"排队超时: {ticket.priority.name} {ticket.role}"))
+                LLM_DROPPED.inc(priority=ticket.priority.name.lower(), reason="expired")
+                continue
+            self.active += 1
+            ticket.future.set_result(True)
+
+    def _release(self):
+        self.active -= 1
+        self._grant_next()
+
+    async def _acquire(self, ticket: _Ticket):
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            return
+        heapq.heappush(self.waiting, (ticket.priority, next(self.seq), ticket))
+        self._grant_next()  # 队列里可能只剩已取消的请求
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            # 调用方被取消：如果已经拿到名额则归还
+            if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+                self._release()
+            raise
+
+    async def run(self, factory: Callable[[], Awaitable[T]], priority: Priority,
+                  role: Optional[str] = None, timeout: Optional[float] = None) -> T:
+        """
+        排队执行一次 LLM 调用。timeout 为从提交开始计算的截止时间（秒），
+        未指定时使用 config.LLM_DEADLINES 中该优先级的默认值。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else self._default_deadline(priority)
+        ticket = _Ticket(priority, role, deadline, loop.create_future())
+        submitted = loop.time()
+        await self._acquire(ticket)
+        LLM_QUEUE_WAIT.observe(loop.time() - submitted, priority=priority.name.lower())
+        try:
+            if deadline is None:
+                return await factory()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                LLM_DROPPED.inc(priority=priority.name.lower(), reason="expired")
+                raise LLMRequestExpired(f"排队超时: {priority.name} {role}")
+            try:
+                return await asyncio.wait_for(factory(), remaining)
+            except asyncio.TimeoutError:
+                LLM_DROPPED.inc(priority=priority.name.lower(), reason="timeout")
+                raise LLMRequestExpired(f"生成超时: {priority.name} {role}")
+        finally:
+            self._release()
+
+    def cancel(self, role: str, min_priority: Priority = Priority.AUTONOMOUS) -> int:
+        """取消某个角色排队中、优先级不高于 min_priority 的请求，返回取消数量"""
+        cancelled = 0
+        for _, _, ticket in self.waiting:
+            if ticket.role == role and ticket.priority >= min_priority and not ticket.future.done():
+                ticket.future.set_exception(LLMRequestCancelled(f"已取消: {ticket.priority.name} {role}"))
+                LLM_DROPPED.inc(priority=ticket.priority.name.lower(), reason="cancelled")
+                cancelled += 1
+        if cancelled:
+            print(f"LLM 调度：取消角色 {role} 的 {cancelled} 个排队请求")
+        return cancelled
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,196 @@
+# memory_columns.py
+# 角色记忆的列式存储：元数据保存在 NumPy 数组中，回忆分桶/去重/打分全部向量化
+from datetime import datetime
+import threading
+from typing import Dict, List, Optional
+import numpy as np
+
+# 始终召回的身份类记忆，以及不参与相似度/最近窗口检索的类型
+SYSTEM_MEMORY_TYPES = ["system", "role_setup", "note"]
+PINNED_MEMORY_TYPES = SYSTEM_MEMORY_TYPES + ["time"]
+
+def _to_epoch(metadata: dict) -> float:
+    """created_ts 优先，旧记忆没有该字段时解析 created_at"""
+    ts = metadata.get("created_ts")
+    if ts is not None:
+        return float(ts)
+    try:
+        return datetime.fromisoformat(metadata.get("created_at", "")).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class MemoryColumns:
+    """
+    单个角色的记忆集合。mems 按行保存完整记忆字典，
+    type / importance / access_count / created_ts / 去重键 以列的形式保存在 NumPy 数组中。
+    """
+    def __init__(self, capacity: int = 256):
+        self.lock = threading.RLock()  # 读方在整个打分过程中持有，避免读到扩容中的列
+        self.mems: List[Dict] = []
+        self.pos: Dict[str, int] = {}
+        self.type_codes: Dict[str, int] = {}
+        self._type = np.zeros(capacity, dtype=np.int32)
+        self._importance = np.zeros(capacity, dtype=np.float64)
+        self._access = np.zeros(capacity, dtype=np.float64)
+        self._created = np.zeros(capacity, dtype=np.float64)
+        self._touched = np.zeros(capacity, dtype=np.float64)   # 最近一次被访问（或创建）的虚拟时间
+        self._dated = np.zeros(capacity, dtype=bool)       # created_at 不是 1970 占位时间
+        self._content_key = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.mems)
+
+    # ---------- 列视图 ----------
+    @property
+    def type(self) -> np.ndarray:
+        return self._type[:len(self.mems)]
+
+    @property
+    def importance(self) -> np.ndarray:
+        return self._importance[:len(self.mems)]
+
+    @property
+    def access(self) -> np.ndarray:
+        return self._access[:len(self.mems)]
+
+    @property
+    def created(self) -> np.ndarray:
+        return self._created[:len(self.mems)]
+
+    # ---------- 写入 ----------
+    def _code(self, mem_type: str) -> int:
+        return self.type_codes.setdefault(mem_type, len(self.type_codes))
+
+    def _grow(self):
+        capacity = len(self._type) * 2
+        for name in ("_type", "_importance", "_access", "_created", "_touched", "_dated", "_content_key"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def upsert(self, mem: Dict):
+        """写入或覆盖一条记忆"""
+        with self.lock:
+            self._upsert(mem)
+
+    def _upsert(self, mem: Dict):
+        row = self.pos.get(mem["id"])
+        if row is None:
+            row = len(self.mems)
+            if row >= len(self._type):
+                self._grow()
+            self.mems.append(mem)
+            self.pos[mem["id"]] = row
+        else:
+            self.mems[row] = mem
+
+        metadata = mem["metadata"]
+        self._type[row] = self._code(metadata.get("type", "note"))
+        self._importance[row] = metadata.get("importance", 1.0)
+        self._access[row] = metadata.get("access_count", 0)
+        self._created[row] = _to_epoch(metadata)
+        self._touched[row] = max(self._created[row], metadata.get("last_accessed_ts", 0.0))
+        self._dated[row] = "1970" not in metadata.get("created_at", "1970-01-01T00:00:00")
+        self._content_key[row] = hash(mem["content"][:100])
+
+    def add_access(self, counts: Dict[str, int], accessed_ts: Optional[float] = None):
+        """访问计数写回后同步到列和记忆字典"""
+        with self.lock:
+            for memory_id, hits in counts.items():
+                row = self.pos.get(memory_id)
+                if row is not None:
+                    self._access[row] += hits
+                    metadata = self.mems[row]["metadata"]
+                    metadata["access_count"] = metadata.get("access_count", 0) + hits
+                    if accessed_ts is not None:
+                        self._touched[row] = max(self._touched[row], accessed_ts)
+                        metadata["last_accessed_ts"] = accessed_ts
+
+    def remove(self, ids: List[str]):
+        """删除记忆并压缩各列（整理/淘汰时调用，频率低）"""
+        with self.lock:
+            drop = {self.pos[i] for i in ids if i in self.pos}
+            if not drop:
+                return
+            n = len(self.mems)
+            keep = np.ones(n, dtype=bool)
+            keep[list(drop)] = False
+            for name in ("_type", "_importance", "_access", "_created", "_touched", "_dated", "_content_key"):
+                column = getattr(self, name)
+                kept = column[:n][keep]
+                column[:len(kept)] = kept
+            self.mems = [mem for row, mem in enumerate(self.mems) if keep[row]]
+            self.pos = {mem["id"]: row for row, mem in enumerate(self.mems)}
+
+    # ---------- 查询 ----------
+    def rows_for(self, ids: List[str]) -> np.ndarray:
+        return np.array([self.pos[i] for i in ids if i in self.pos], dtype=np.int64)
+
+    def type_mask(self, types: List[str]) -> np.ndarray:
+        codes = [self.type_codes[t] for t in types if t in self.type_codes]
+        return np.isin(self.type, codes)
+
+    def latest(self, mask: np.ndarray, n: int) -> np.ndarray:
+        """mask 中 created_ts 最大的 n 行（按时间升序）"""
+        rows = np.flatnonzero(mask)
+        if len(rows) > n:
+            rows = rows[np.argpartition(self.created[rows], len(rows) - n)[len(rows) - n:]]
+        return rows[np.argsort(self.created[rows], kind="stable")]
+
+    def access_with(self, pending: Optional[Dict[str, int]] = None) -> np.ndarray:
+        """叠加尚未写回的访问次数后的 access_count 列"""
+        access = self.access.copy()
+        for memory_id, hits in (pending or {}).items():
+            row = self.pos.get(memory_id)
+            if row is not None:
+                access[row] += hits
+        return access
+
+    def retention_value(self, now_ts: float, half_life_hours: float) -> np.ndarray:
+        """
+        衰减后的记忆价值：重要性按距上次访问的虚拟时长做半衰期衰减，
+        访问次数越多强化越明显（与回忆打分中的 1 + access × 0.5 一致）
+        """
+        idle_hours = np.maximum(now_ts - self._touched[:len(self.mems)], 0.0) / 3600.0
+        decay = np.power(0.5, idle_hours / half_life_hours)
+        return self.importance * decay * (1 + self.access * 0.5)
+
+    def recall_scan(self, access: np.ndarray, recent_count: int = 8) -> np.ndarray:
+        """全量模式的智能回忆分桶，返回按优先级拼接的行号"""
+        pinned = self.type_mask(PINNED_MEMORY_TYPES)
+
+        # 1. 系统身份记忆
+        system_rows = np.flatnonzero(self.type_mask(SYSTEM_MEMORY_TYPES))
+        # 2. 最新的时间记忆
+        time_rows = self.latest(self.type_mask(["time"]), 1)
+        # 3. 高重要性记忆 / 4. 频繁访问记忆
+        important_rows = np.flatnonzero((self.importance > 5.0) & ~pinned)
+        frequent_rows = np.flatnonzero((access > 3) & ~pinned)
+        # 5. 最近记忆（排除已选记忆）
+        selected = np.zeros(len(self), dtype=bool)
+        for rows in (system_rows, time_rows, important_rows, frequent_rows):
+            selected[rows] = True
+        recent_rows = self.latest(~selected, recent_count)
+
+        return np.concatenate([system_rows, time_rows, important_rows, frequent_rows, recent_rows])
+
+    def rank(self, rows: np.ndarray, access: np.ndarray, limit: Optional[int] = None) -> np.ndarray:
+        """基于内容去重，并按 重要性 × 访问 × 时间 综合得分排序"""
+        if len(rows) == 0:
+            return rows
+        # 去重：保留每个内容键第一次出现的位置，维持召回顺序
+        _, first = np.unique(self._content_key[rows], return_index=True)
+        rows = rows[np.sort(first)]
+
+        importance = self.importance[rows].copy()
+        if "time" in self.type_codes:
+            importance[self.type[rows] == self.type_codes["time"]] *= 3.0  # 时间记忆的特殊权重
+        time_factor = np.where(self._dated[rows], 2.0, 1.0)
+        score = importance * (1 + access[rows] * 0.5) * time_factor
+
+        order = np.argsort(-score, kind="stable")
+        if limit is not None:
+            order = order[:limit]
+        return rows[order]
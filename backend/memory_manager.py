@@ -3,20 +3,29 @@ import asyncio
 from zoneinfo import ZoneInfo
 import chromadb
 from chromadb.config import Settings
-from roomAsyc import RoomSenseParser
-from room import get_room
-from config import CHROMA_DB_DIR
+from config import (
+    CHROMA_DB_DIR, MAX_MEMORY_TO_FEED, MEMORY_RETRIEVAL_MODE,
+    RECENT_MEMORY_WINDOW_MINUTES, RECENT_MEMORY_COUNT, ACCESS_COUNT_FLUSH_INTERVAL,
+    MEMORY_TIER_MAX_ROLES, STREAM_REPLIES
+)
 import uuid
+import threading
+from collections import OrderedDict
+import numpy as np
 from datetime import datetime, timezone, timedelta
 import re
 import os
-import json
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Tuple
 from chromadb import Client
 # 引入必要的 Pydantic 依赖
 from pydantic import BaseModel, Field
 import re
-from ollama_client import run_ollama_sync
+from ollama_client import run_ollama, run_ollama_stream
+from response_stream import NpcResponse, parse_response
+from llm_scheduler import llm_scheduler, Priority
+from metrics import MEMORY_QUERY
+from embedding_service import embedding_service
+from memory_columns import MemoryColumns, SYSTEM_MEMORY_TYPES, PINNED_MEMORY_TYPES
 # 导入时间管理器
 from time_manager import get_accelerated_time
 
@@ -66,17 +75,43 @@ def sanitize_name(name: str) -> str:
 # Collection 管理
 # -----------------------
 def list_roles() -> List[str]:
-    print( "Existing collections:", client.list_collections())  # 调试输出
-    return [col.name for col in client.list_collections()]
+    collections = client.list_collections()
+    print( "Existing collections:", collections)  # 调试输出
+    return [col.name for col in collections]
+
+# 进程级 collection 句柄缓存：{sanitize_name(role): collection}
+_collection_cache = {}
+_collection_cache_lock = threading.Lock()
 
 def get_or_create_collection(role: str):
     role_safe = sanitize_name(role)
-    existing = [c.name for c in client.list_collections()]
-    print('Creating collection:', role_safe,client.list_collections())  # 调试输出
-    if role_safe not in existing:
-        
-        return client.create_collection(name=role_safe)
-    return client.get_collection(name=role_safe)
+    collection = _collection_cache.get(role_safe)
+    if collection is not None:
+        return collection
+    with _collection_cache_lock:
+        collection = _collection_cache.get(role_safe)
+        if collection is None:
+            collection = client.get_or_create_collection(name=role_safe)
+            _collection_cache[role_safe] = collection
+        return collection
+
+def find_collection(role: str):
+    """获取已存在的 collection，不存在时返回 None（不会创建）"""
+    role_safe = sanitize_name(role)
+    collection = _collection_cache.get(role_safe)
+    if collection is not None:
+        return collection
+    try:
+        collection = client.get_collection(name=role_safe)
+    except Exception:
+        return None
+    with _collection_cache_lock:
+        return _collection_cache.setdefault(role_safe, collection)
+
+def invalidate_collection(role: str):
+    """使某个角色的 collection 句柄缓存失效"""
+    with _collection_cache_lock:
+        _collection_cache.pop(sanitize_name(role), None)
 
 # -----------------------
 # 添加记忆
@@ -98,6 +133,7 @@ class MemoryManager:
         type_weights = {
             "system": 10.0,    # 系统指令最重要
             "narrative": 4.0,   # 新增：旁白记忆，比普通对话更重要
+            "summary": 4.0,    # 整理后的情景摘要
             "emotion": 8.0,    # 情感记忆
             "conversation": 3.0, # 对话记忆
             "hearing": 2.0,    # 听到的内容
@@ -119,31 +155,209 @@ class MemoryManager:
 # 全局记忆管理器
 memory_manager = MemoryManager()
 
-def add_memory(role: str, content: str, mtype: str = "note") -> None:
-    try:
-        memory_id = str(uuid.uuid4())
-        # 使用统一的时间管理器获取时间
-        time_info = get_accelerated_time()
-        timestamp = time_info["virtual_time"].isoformat()
-
-        importance = memory_manager.calculate_importance(content, mtype, role)
-        
-        collection = get_or_create_collection(role)
-        collection.add(
-            ids=[memory_id],
-            documents=[content],
-            metadatas=[{
-                "type": mtype, 
-                "created_at": timestamp,
-                "importance": importance,
-                "access_count": 0
-            }]
-        )
-        
-        print(f"添加记忆: [{mtype}] 重要性:{importance:.1f} - {content[:30]}...")
+def add_memories(entries: List[Tuple[str, str, str]], virtual_time: Optional[datetime] = None) -> List[Optional[str]]:
+    """
+    批量添加记忆 [(role, content, mtype), ...]，返回与 entries 对应的记忆 id 列表（失败的为 None）。
+    所有内容一次嵌入，每个角色只调用一次 collection.add。
+    virtual_time 为空时使用当前虚拟时间（整理摘要时沿用原始片段的时间）
+    """
+    if not entries:
+        return []
+    # 使用统一的时间管理器获取时间
+    virtual_time = virtual_time or get_accelerated_time()["virtual_time"]
+    timestamp = virtual_time.isoformat()
+    memory_ids: List[Optional[str]] = [None] * len(entries)
 
+    try:
+        embeddings = embedding_service.embed([content for _, content, _ in entries])
     except Exception as e:
         print(f"Error adding memory: {e}")
+        return memory_ids
+
+    # 按 collection 分组
+    groups = {}
+    for i, (role, content, mtype) in enumerate(entries):
+        groups.setdefault(sanitize_name(role), []).append(i)
+
+    for role_safe, indexes in groups.items():
+        try:
+            ids, documents, metadatas = [], [], []
+            for i in indexes:
+                role, content, mtype = entries[i]
+                ids.append(str(uuid.uuid4()))
+                documents.append(content)
+                metadatas.append({
+                    "type": mtype,
+                    "created_at": timestamp,
+                    "created_ts": virtual_time.timestamp(),
+                    "importance": memory_manager.calculate_importance(content, mtype, role),
+                    "access_count": 0
+                })
+            collection = get_or_create_collection(role_safe)
+            collection.add(
+                ids=ids,
+                documents=documents,
+                metadatas=metadatas,
+                embeddings=[embeddings[i] for i in indexes]
+            )
+            memory_tier.put(role_safe, [
+                {"id": memory_id, "content": content, "metadata": dict(metadata)}
+                for memory_id, content, metadata in zip(ids, documents, metadatas)
+            ])
+            for i, memory_id, metadata, content in zip(indexes, ids, metadatas, documents):
+                memory_ids[i] = memory_id
+                print(f"添加记忆: [{metadata['type']}] 重要性:{metadata['importance']:.1f} - {content[:30]}...")
+        except Exception as e:
+            print(f"Error adding memory ({role_safe}): {e}")
+
+    return memory_ids
+
+def add_memory(role: str, content: str, mtype: str = "note", virtual_time: Optional[datetime] = None) -> Optional[str]:
+    """添加一条记忆，返回记忆 id（失败时返回 None）"""
+    return add_memories([(role, content, mtype)], virtual_time)[0]
+
+# -----------------------
+# 记忆写入队列（按事件循环 tick 合并）
+# -----------------------
+class MemoryWriteQueue:
+    """
+    在事件循环中收集同一个 tick 内提交的记忆写入，
+    下一次循环迭代时合并为一次 add_memories 调用（一次线程切换、每个角色一次写入）
+    """
+    def __init__(self):
+        self.pending = []  # [((role, content, mtype), Future)]
+        self.flush_handle = None
+        self.inflight = set()
+
+    def submit(self, role: str, content: str, mtype: str = "note") -> asyncio.Future:
+        """提交一条写入，返回在写入完成后得到记忆 id 的 Future（可以不 await）"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((role, content, mtype), future))
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._write(batch))
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def _write(self, batch):
+        try:
+            memory_ids = await asyncio.to_thread(add_memories, [entry for entry, _ in batch])
+        except Exception as e:
+            print(f"批量写入记忆失败: {e}")
+            memory_ids = [None] * len(batch)
+        for (_, future), memory_id in zip(batch, memory_ids):
+            if not future.done():
+                future.set_result(memory_id)
+
+    async def drain(self):
+        """等待所有已提交的写入完成"""
+        while self.pending or self.inflight:
+            if self.inflight:
+                await asyncio.gather(*list(self.inflight))
+            else:
+                await asyncio.sleep(0)
+
+memory_writer = MemoryWriteQueue()
+
+# -----------------------
+# 访问计数累加器（write-behind）
+# -----------------------
+class AccessCounter:
+    """
+    在进程内累计记忆的访问次数，检索时立即叠加到打分中，
+    由定时任务或关闭时一次性批量写回 Chroma，避免每条记忆一次 update。
+    """
+    def __init__(self):
+        self.pending = {}  # {role_safe: {memory_id: 待写回的访问次数}}
+        self.lock = threading.Lock()
+
+    def record(self, role: str, memory_ids: List[str]):
+        """记录一次命中（只记录真正进入 prompt 的记忆）"""
+        role_safe = sanitize_name(role)
+        with self.lock:
+            role_pending = self.pending.setdefault(role_safe, {})
+            for memory_id in memory_ids:
+                role_pending[memory_id] = role_pending.get(memory_id, 0) + 1
+
+    def pending_for(self, role: str) -> Dict[str, int]:
+        """某个角色尚未写回的访问次数 {memory_id: 次数}"""
+        with self.lock:
+            return dict(self.pending.get(sanitize_name(role), {}))
+
+    def forget(self, role: str, memory_ids: List[str]):
+        """丢弃指定记忆尚未写回的计数（记忆被删除时调用）"""
+        with self.lock:
+            role_pending = self.pending.get(sanitize_name(role), {})
+            for memory_id in memory_ids:
+                role_pending.pop(memory_id, None)
+
+    def discard(self, role: str):
+        """丢弃某个角色尚未写回的计数（删除 collection 时调用）"""
+        with self.lock:
+            self.pending.pop(sanitize_name(role), None)
+
+    def flush(self) -> int:
+        """将累计的访问次数按角色批量写回 Chroma，返回写回的记忆条数"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        flushed = 0
+        # 记录最近访问的虚拟时间，用于重要性衰减（访问即强化）
+        accessed_ts = get_accelerated_time()["virtual_time"].timestamp()
+        for role_safe, counts in pending.items():
+            written = False
+            try:
+                collection = find_collection(role_safe)
+                if collection is None:
+                    continue
+                ids = list(counts.keys())
+                current = collection.get(ids=ids, include=["metadatas"])
+                found_ids = current.get("ids", [])
+                metadatas = []
+                for memory_id, metadata in zip(found_ids, current.get("metadatas", [])):
+                    metadata = dict(metadata or {})
+                    metadata["access_count"] = metadata.get("access_count", 0) + counts[memory_id]
+                    metadata["last_accessed_ts"] = accessed_ts
+                    metadatas.append(metadata)
+                if found_ids:
+                    collection.update(ids=found_ids, metadatas=metadatas)
+                    written = True
+                    memory_tier.add_access_counts(
+                        role_safe, {i: counts[i] for i in found_ids}, accessed_ts,
+                        totals={i: m["access_count"] for i, m in zip(found_ids, metadatas)}
+                    )
+                    flushed += len(found_ids)
+            except Exception as e:
+                print(f"写回访问计数失败 - 角色 {role_safe}: {e}")
+                if written:
+                    continue  # Chroma 已写入，只是镜像同步失败，重试会重复累加
+                # 放回待写队列，下次 flush 重试（与期间新增的计数合并）
+                with self.lock:
+                    role_pending = self.pending.setdefault(role_safe, {})
+                    for memory_id, hits in counts.items():
+                        role_pending[memory_id] = role_pending.get(memory_id, 0) + hits
+        if flushed:
+            print(f"批量写回访问计数: {flushed} 条记忆")
+        return flushed
+
+access_counter = AccessCounter()
+
+async def flush_access_counts_periodically(interval: float = ACCESS_COUNT_FLUSH_INTERVAL):
+    """定时批量写回访问计数"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(access_counter.flush)
+        except Exception as e:
+            print(f"定时写回访问计数失败: {e}")
 
 # -----------------------
 # 休息状态管理
@@ -178,6 +392,43 @@ class RestStateManager:
 
 rest_manager = RestStateManager()
 
+# -----------------------
+# 易变上下文（时间 / 休息状态 / 房间感知）
+# -----------------------
+class RoleContextProvider:
+    """
+    角色的易变事实只保存在内存中，构造 prompt 时注入，
+    不写入向量库，避免每个时间刻度都改写并重新嵌入时间记忆。
+    当前时间在读取时直接取虚拟时钟，不按角色保存。
+    """
+    def __init__(self):
+        self.contexts = {}  # {role: {"room_sense": str}}
+        self.lock = threading.Lock()
+
+    def update_room_sense(self, role: str, room_sense: str):
+        with self.lock:
+            self.contexts.setdefault(role, {})["room_sense"] = room_sense
+
+    def get(self, role: str) -> dict:
+        """返回 {virtual_time, time_str, rest_state, room_sense}"""
+        with self.lock:
+            context = dict(self.contexts.get(role, {}))
+        virtual_time = get_accelerated_time()["virtual_time"]
+        rest_info = rest_manager.get_rest_info(role)
+        rest_state = f"正在{rest_info.get('rest_type') or '休息'}" if rest_info.get("is_resting") else "清醒"
+        return {
+            "virtual_time": virtual_time,
+            "time_str": virtual_time.strftime("%H:%M"),
+            "rest_state": rest_state,
+            "room_sense": context.get("room_sense", "")
+        }
+
+    def discard(self, role: str):
+        with self.lock:
+            self.contexts.pop(role, None)
+
+context_provider = RoleContextProvider()
+
 def check_rest_state(role: str, current_time: datetime) -> dict:
     """AI决定角色是否应该休息"""
     try:
@@ -215,177 +466,248 @@ def update_rest_states():
     except Exception as e:
         print(f"更新休息状态失败: {e}")
 
-def query_memory(role: str, query: str, top_k: int = 100000) -> List[Dict]:
-    """获取所有记忆，兼容旧版本 ChromaDB"""
-    role_safe = sanitize_name(role)
-    existing = [c.name for c in client.list_collections()]
-    if role_safe not in existing:
-        return []
+# -----------------------
+# 记忆检索
+# -----------------------
+def _to_mems(ids: list, documents: list, metadatas: list) -> List[Dict]:
+    """将 Chroma 返回的平行列表组装为记忆字典列表"""
+    min_length = min(len(documents), len(metadatas), len(ids))
+    mems = []
+    for i in range(min_length):
+        metadata = metadatas[i] if metadatas[i] else {
+            "type": "note",
+            "created_at": "1970-01-01T00:00:00",
+            "importance": 1.0,
+            "access_count": 0
+        }
+        mems.append({
+            "id": ids[i] if i < len(ids) else str(i),
+            "content": documents[i],
+            "metadata": metadata
+        })
+    return mems
+
+# -----------------------
+# 热记忆层（进程内，write-through）
+# -----------------------
+class MemoryTier:
+    """
+    每个角色一份进程内的记忆镜像（列式的 MemoryColumns）。
+    首次访问时从 Chroma 全量加载，之后由 add_memory 同步写入，
+    角色数量超过上限时按 LRU 淘汰。Chroma 仍是持久化存储。
+    加载期间到达的写入先缓冲，加载完成后重放，避免丢失在读取 Chroma 之后提交的记忆。
+    """
+    def __init__(self, max_roles: int = MEMORY_TIER_MAX_ROLES):
+        self.max_roles = max_roles
+        self.roles = OrderedDict()  # {role_safe: MemoryColumns}
+        self.loading = {}           # {role_safe: [加载期间缓冲的写入操作]}
+        self.lock = threading.Lock()
+
+    def get(self, role: str) -> Optional[MemoryColumns]:
+        """获取角色的记忆镜像，未加载时从 Chroma 加载；collection 不存在时返回 None"""
+        role_safe = sanitize_name(role)
+        with self.lock:
+            memories = self.roles.get(role_safe)
+            if memories is not None:
+                self.roles.move_to_end(role_safe)
+                return memories
+            # 从此刻起的写入进入缓冲区（并发加载的线程共用同一个缓冲区）
+            self.loading.setdefault(role_safe, [])
+
+        try:
+            collection = find_collection(role)
+            all_results = collection.get(include=["documents", "metadatas"]) if collection is not None else None
+        except Exception:
+            with self.lock:
+                self.loading.pop(role_safe, None)
+            raise
+        if all_results is None:
+            with self.lock:
+                self.loading.pop(role_safe, None)
+            return None
+        loaded = MemoryColumns()
+        for mem in _to_mems(
+            all_results.get("ids", []),
+            all_results.get("documents", []),
+            all_results.get("metadatas", [])
+        ):
+            loaded.upsert(mem)
+        print(f"热记忆层加载角色 {role}: {len(loaded)} 条记忆")
+
+        with self.lock:
+            # 加载期间可能已有其他线程完成加载，以先到者为准
+            memories = self.roles.get(role_safe)
+            if memories is None:
+                memories = self.roles[role_safe] = loaded
+                # 重放加载期间的写入（操作均为幂等，读取时已包含的写入重放后结果不变）
+                for op in self.loading.pop(role_safe, []):
+                    op(memories)
+            self.roles.move_to_end(role_safe)
+            while len(self.roles) > self.max_roles:
+                evicted, _ = self.roles.popitem(last=False)
+                print(f"热记忆层淘汰角色: {evicted}")
+            return memories
+
+    def _apply(self, role: str, op: Callable[[MemoryColumns], None], buffered_op: Optional[Callable] = None):
+        """
+        对已加载的角色执行 op；角色正在加载时把 buffered_op（默认同 op）缓冲到加载完成后重放；
+        未加载的角色直接忽略，下次会从 Chroma 读到
+        """
+        role_safe = sanitize_name(role)
+        with self.lock:
+            memories = self.roles.get(role_safe)
+            if memories is None:
+                pending = self.loading.get(role_safe)
+                if pending is not None:
+                    pending.append(buffered_op or op)
+                return
+        op(memories)
+
+    def put(self, role: str, mems: List[Dict]):
+        """写入或覆盖记忆"""
+        def op(memories: MemoryColumns):
+            for mem in mems:
+                memories.upsert(mem)
+        self._apply(role, op)
+
+    def add_access_counts(self, role: str, counts: Dict[str, int], accessed_ts: Optional[float] = None,
+                          totals: Optional[Dict[str, int]] = None):
+        """
+        访问计数写回 Chroma 后同步到镜像。totals 为写回后的 access_count 绝对值，
+        加载期间缓冲时按绝对值补齐，避免与读取时已包含的计数重复累加
+        """
+        def catch_up(memories: MemoryColumns):
+            with memories.lock:
+                missing = {}
+                for memory_id, total in totals.items():
+                    row = memories.pos.get(memory_id)
+                    if row is not None:
+                        behind = total - memories.mems[row]["metadata"].get("access_count", 0)
+                        if behind > 0:
+                            missing[memory_id] = behind
+            memories.add_access(missing, accessed_ts)
+        self._apply(role, lambda memories: memories.add_access(counts, accessed_ts),
+                    catch_up if totals is not None else None)
+
+    def remove(self, role: str, memory_ids: List[str]):
+        self._apply(role, lambda memories: memories.remove(memory_ids))
+
+    def evict(self, role: str):
+        with self.lock:
+            self.roles.pop(sanitize_name(role), None)
+
+memory_tier = MemoryTier()
+
+def _copy_mem(mem: Dict) -> Dict:
+    """复制一条记忆（元数据会被修改，避免污染热记忆层）"""
+    return {"id": mem["id"], "content": mem["content"], "metadata": dict(mem["metadata"])}
+
+def _vector_rows(collection, cols: MemoryColumns, query: str, top_k: int) -> Dict[str, np.ndarray]:
+    """
+    向量检索：按类型桶 + 相似度 + 最近窗口分别选出候选记忆的行号。
+    类型桶直接在列上用掩码过滤；相似度检索只向 Chroma 要 id。
+    """
+    def search(where: dict, n_results: int) -> np.ndarray:
+        try:
+            res = collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=where,
+                include=["distances"]
+            )
+            return cols.rows_for((res.get("ids") or [[]])[0])
+        except Exception as e:
+            print(f"相似度检索失败 {where}: {e}")
+            return cols.rows_for([])
+
+    has_query = bool(query and query.strip())
+    # 查询向量只计算一次，两个相似度桶共用
+    query_embeddings = embedding_service.embed([query]) if has_query else None
+    not_pinned = ~cols.type_mask(PINNED_MEMORY_TYPES)
+    buckets = {}
 
-    collection = client.get_collection(name=role_safe)
+    # 1. 系统身份记忆
+    buckets["system"] = np.flatnonzero(cols.type_mask(SYSTEM_MEMORY_TYPES))[:MAX_MEMORY_TO_FEED]
+
+    # 2. 时间不再从向量库召回，由 context_provider 在构造 prompt 时注入
+
+    # 3. 高重要性 / 频繁访问记忆
+    if has_query:
+        salient_where = {"$and": [
+            {"type": {"$nin": PINNED_MEMORY_TYPES}},
+            {"$or": [{"importance": {"$gt": 5.0}}, {"access_count": {"$gt": 3}}]}
+        ]}
+        buckets["important"] = search(salient_where, top_k)
+    else:
+        salient = not_pinned & ((cols.importance > 5.0) | (cols.access > 3))
+        buckets["important"] = cols.latest(salient, top_k)
+
+    # 4. 与当前话题相似的记忆
+    buckets["similar"] = search({"type": {"$nin": PINNED_MEMORY_TYPES}}, top_k) if has_query else cols.rows_for([])
+
+    # 5. 最近窗口
+    since = (get_accelerated_time()["virtual_time"] - timedelta(minutes=RECENT_MEMORY_WINDOW_MINUTES)).timestamp()
+    buckets["recent"] = cols.latest(not_pinned & (cols.created >= since), RECENT_MEMORY_COUNT)
+
+    return buckets
+
+def query_memory(role: str, query: str, top_k: int = MAX_MEMORY_TO_FEED, mode: Optional[str] = None) -> List[Dict]:
+    """
+    检索角色记忆。
+    - mode="vector"：按相似度 top-k + 类型桶 + 最近窗口检索，结果上限为 MAX_MEMORY_TO_FEED
+    - mode="scan"：全量扫描所有记忆（供记忆管理页面使用）
+    未指定时使用 config.MEMORY_RETRIEVAL_MODE。
+    """
+    mode = mode or MEMORY_RETRIEVAL_MODE
+    with MEMORY_QUERY.time(mode=mode):
+        return _query_memory(role, query, top_k, mode)
+
+def _query_memory(role: str, query: str, top_k: int, mode: str) -> List[Dict]:
+    collection = find_collection(role)
+    if collection is None:
+        return []
 
     try:
-        # 🔥 使用 get() 方法获取所有记忆（更兼容）
-        # 先获取总数
-        count_result = collection.count()
-        total_count = count_result if isinstance(count_result, int) else count_result.get('count', 0)
-        
+        # 从热记忆层读取（首次访问时从 Chroma 加载）
+        cols = memory_tier.get(role)
+        total_count = len(cols) if cols else 0
+
         print(f"角色 {role} 共有 {total_count} 条记忆")
-        
+
         if total_count == 0:
             return []
-        
-        # 使用 get() 获取所有记录（更可靠）
-        all_results = collection.get(
-            include=["documents", "metadatas"],
-            limit=min(total_count, 100000)  # 限制最大获取数量
-        )
-        
-        documents = all_results.get("documents", [])
-        metadatas = all_results.get("metadatas", [])
-        ids = all_results.get("ids", [])
-        
-        print(f"实际获取了 {len(documents)} 条记忆")
-        
-        # 处理记忆数据
-        min_length = min(len(documents), len(metadatas), len(ids))
-        
-        mems = []
-        for i in range(min_length):
-            metadata = metadatas[i] if metadatas[i] else {
-                "type": "note", 
-                "created_at": "1970-01-01T00:00:00",
-                "importance": 1.0,
-                "access_count": 0
-            }
-            mems.append({
-                "id": ids[i] if i < len(ids) else str(i),
-                "content": documents[i],
-                "metadata": metadata
-            })
-        
-        # 更新访问计数（模拟记忆强化）
-        for mem in mems:
-            if "access_count" not in mem["metadata"]:
-                mem["metadata"]["access_count"] = 0
+
+        with cols.lock:
+            # 叠加尚未写回的访问计数后再打分
+            access = cols.access_with(access_counter.pending_for(role))
+            if mode == "scan":
+                # 🔥 智能回忆算法
+                candidates = cols.recall_scan(access)
+                rows = cols.rank(candidates, access)
+            else:
+                buckets = _vector_rows(collection, cols, query, top_k)
+                candidates = np.concatenate(list(buckets.values()))
+                print(f"向量检索候选 {len(candidates)} 条记忆（" + ", ".join(f"{k}:{len(v)}" for k, v in buckets.items()) + "）")
+                rows = cols.rank(candidates, access, limit=MAX_MEMORY_TO_FEED)
+
+            final_mems = []
+            for row in rows:
+                mem = _copy_mem(cols.mems[row])
+                mem["metadata"]["access_count"] = int(access[row])
+                final_mems.append(mem)
+
+        # 更新访问计数（模拟记忆强化）：只统计最终进入回忆的记忆，由 access_counter 批量写回
+        access_counter.record(role, [mem["id"] for mem in final_mems])
+        for mem in final_mems:
             mem["metadata"]["access_count"] += 1
-            
-            # 更新访问计数到数据库
-            try:
-                collection.update(
-                    ids=[mem.get("id", str(uuid.uuid4()))],
-                    metadatas=[mem["metadata"]]
-                )
-            except Exception as e:
-                print(f"更新访问计数失败: {e}")
-        
-        # 🔥 智能回忆算法
-        recall_memories = []
-        
-        # 1. 系统身份记忆（最高优先级）
-        system_mems = [mem for mem in mems if mem["metadata"].get("type") in ["system", "role_setup", "note"]]
-        recall_memories.extend(system_mems)
-        
-        # 2. 时间记忆（重要背景信息）
-        time_mems = [mem for mem in mems if mem["metadata"].get("type") == "time"]
-        # 取最新的时间记忆
-        if time_mems:
-            latest_time_mem = sorted(time_mems, 
-                                   key=lambda x: x["metadata"].get("created_at", "1970-01-01T00:00:00"))[-1]
-            recall_memories.append(latest_time_mem)
-        
-        # 3. 高重要性记忆
-        important_mems = [mem for mem in mems 
-                         if mem["metadata"].get("importance", 1.0) > 5.0 
-                         and mem["metadata"].get("type") not in ["system", "role_setup", "note", "time"]]
-        recall_memories.extend(important_mems)
-        
-        # 4. 频繁访问记忆
-        frequent_mems = [mem for mem in mems 
-                        if mem["metadata"].get("access_count", 0) > 3
-                        and mem["metadata"].get("type") not in ["system", "role_setup", "note", "time"]]
-        recall_memories.extend(frequent_mems)
-        
-        # 5. 最近记忆（短期记忆）
-        other_mems = [mem for mem in mems 
-                     if mem not in recall_memories]  # 排除已选记忆
-        recent_mems = sorted(other_mems, 
-                           key=lambda x: x["metadata"].get("created_at", "1970-01-01T00:00:00"))[-8:]
-        recall_memories.extend(recent_mems)
-        
-        # 去重（基于内容）
-        unique_mems = {}
-        for mem in recall_memories:
-            key = mem["content"][:100]  # 基于内容去重
-            if key not in unique_mems:
-                unique_mems[key] = mem
-        
-        final_mems = list(unique_mems.values())
-        
-        # 按综合得分排序
-        def memory_score(mem):
-            importance = mem["metadata"].get("importance", 1.0)
-            access_count = mem["metadata"].get("access_count", 0)
-            create_time = mem["metadata"].get("created_at", "1970-01-01T00:00:00")
-            time_factor = 1.0 if "1970" in create_time else 2.0
-            
-            # 时间记忆的特殊权重
-            if mem["metadata"].get("type") == "time":
-                importance *= 3.0
-            
-            return importance * (1 + access_count * 0.5) * time_factor
-        
-        final_mems.sort(key=memory_score, reverse=True)
-        
-        print(f"角色 {role} 智能回忆: {len(final_mems)} 条记忆（总数: {len(mems)}）")
+
+        print(f"角色 {role} 智能回忆: {len(final_mems)} 条记忆（候选: {len(candidates)}）")
         for i, mem in enumerate(final_mems[:5]):  # 只显示前5条
             importance = mem["metadata"].get("importance", 1.0)
             access_count = mem["metadata"].get("access_count", 0)
             mem_type = mem["metadata"].get("type", "unknown")
             print(f"  {i+1}. [{mem_type}] 重要性:{importance:.1f} 访问:{access_count} - {mem['content'][:50]}...")
 
-
-        # ✅ 2. 获取并解析房间数据
-        try:
-            room = get_room()
-            room_data = room.model_dump()
-            
-            # 初始化解析器
-            parser = RoomSenseParser(room_data)
-            room_raw_json = json.dumps(room.model_dump(), ensure_ascii=False)
-            # 解析当前角色的主视角 (假设变量 role 是当前角色的名称，如 "user" 或 "yui1")
-            user_view = parser.parse_for_role(role)
-        except Exception as e:
-            # 容错处理：如果解析失败，记录简化的错误信息，避免对话中断
-            user_view = f"你当前身处室内，但视觉观察受限（解析错误: {e}）"
-
-        # ✅ 3. 获取时间信息
-        time_info = get_accelerated_time()
-        timestamp = time_info["virtual_time"].isoformat()
-
-        # ✅ 4. 写入记忆
-        final_mems.append({
-            "id": f"spatial_sense_{timestamp}", # 建议 ID 加上时间戳区分
-            "content": user_view,
-            "metadata": {
-                "type": "room_state",
-                "created_at": timestamp,
-                "importance": 10.0,
-                "access_count": 0
-            }
-        })
-        # ✅ 4. 写入记忆
-        final_mems.append({
-            "id": f"room_json_{timestamp}", # 建议 ID 加上时间戳区分
-            "content": room_raw_json,
-            "metadata": {
-                "type": "room_state",
-                "created_at": timestamp,
-                "importance": 10.0,
-                "access_count": 0
-            }
-        })
-
         return final_mems
         
     except Exception as e:
@@ -399,76 +721,38 @@ def delete_collection(role: str) -> bool:
     """删除指定角色的记忆 collection"""
     try:
         role_safe = sanitize_name(role)
-        # 检查集合是否存在
-        existing_collections = [c.name for c in client.list_collections()]
-        if role_safe in existing_collections:
+        from retention import memory_archive  # 局部导入，防止循环依赖
+        access_counter.discard(role)
+        context_provider.discard(role)
+        memory_tier.evict(role)
+        memory_archive.delete(role)
+        invalidate_collection(role)
+        try:
             client.delete_collection(name=role_safe)
-            return True
-        else:
-            # 集合不存在，也算删除成功（幂等操作）
-            return True
+        except Exception:
+            # 集合不存在，也算删除成功（幂等操作）；只有确实还存在时才视为失败
+            if role_safe in [c.name for c in client.list_collections()]:
+                raise
+        return True
     except Exception as e:
         print(f"删除角色 {role} 记忆失败: {e}")
         return False
 
 
-# 在 memory_manager.py 中添加
-def update_time_memory(role: str, current_time_info: dict):
-    """更新时间记忆（修改或创建唯一的时间记忆）"""
+def delete_memories(role: str, memory_ids: List[str]) -> bool:
+    """从向量库和热记忆层中删除指定记忆"""
+    if not memory_ids:
+        return True
     try:
-        # 🔥 使用统一的时间管理器提供的时间信息
-        timestamp = current_time_info["virtual_time"].isoformat()
-        
-        # 格式化时间记忆内容
-        time_memory_content = f"当前时间：{timestamp}。"
-        
-        role_safe = sanitize_name(role)
-        collection = get_or_create_collection(role_safe)
-        
-        # 查找现有的时间记忆
-        existing_memories = collection.peek(limit=1000)
-        documents = existing_memories.get("documents", [])
-        metadatas = existing_memories.get("metadatas", [])
-        ids = existing_memories.get("ids", [])
-        
-        time_memory_id = None
-        
-        # 查找时间记忆（类型为"time"）
-        for i, metadata in enumerate(metadatas):
-            if i < len(ids) and metadata and metadata.get("type") == "time":
-                time_memory_id = ids[i]
-                break
-        
-        if time_memory_id:
-            # 更新时间记忆
-            collection.update(
-                ids=[time_memory_id],
-                documents=[time_memory_content],
-                metadatas=[{
-                    "type": "time", 
-                    "created_at": timestamp,
-                    "importance": 8.0,
-                    "access_count": 0
-                }]
-            )
-            print(f"更新时间记忆 - 角色 {role}: {timestamp}")
-        else:
-            # 创建新的时间记忆
-            memory_id = str(uuid.uuid4())
-            collection.add(
-                ids=[memory_id],
-                documents=[time_memory_content],
-                metadatas=[{
-                    "type": "time", 
-                    "created_at": timestamp,
-                    "importance": 8.0,
-                    "access_count": 0
-                }]
-            )
-            print(f"创建时间记忆 - 角色 {role}: {timestamp}")
-        
+        collection = find_collection(role)
+        if collection is not None:
+            collection.delete(ids=memory_ids)
+        access_counter.forget(role, memory_ids)
+        memory_tier.remove(role, memory_ids)
+        return True
     except Exception as e:
-        print(f"更新时间记忆失败: {e}")
+        print(f"删除角色 {role} 的 {len(memory_ids)} 条记忆失败: {e}")
+        return False
 
 # -----------------------
 # 角色活动状态函数 (App.py 需要)
@@ -485,25 +769,47 @@ def get_role_activity(role_name: str) -> str:
         
     # 默认状态
     return "思考下一步行动"
-async def handle_npc_response(role, user_message: str, room):
+def resolve_action(room, response: Optional[NpcResponse]) -> Optional[Tuple[int, int, str]]:
+    """根据解析出的指令在房间布局中寻找移动目标，返回 (x, y, 动作描述)，无需移动时返回 None"""
+    # "move" 和 "talk_and_move" 都視為需要移動
+    if response is None or response.action not in ["move", "talk_and_move"]:
+        return None
+    target_name = response.target
+    for f in room.layout.furniture or []:
+        if f.name == target_name:
+            return f.x, f.y, f"已移動到 {target_name}"
+    # 如果家具沒找到，找門 (Doors)
+    for d in room.layout.doors or []:
+        if d.name == target_name:
+            return d.x, d.y, f"已穿過 {target_name}"
+    return None
+
+async def handle_npc_response(role, user_message: str, room, on_delta=None, priority: Priority = Priority.USER,
+                              apply_actions: bool = True):
     """
     处理 AI 的思考、回复和动作执行。
     保留你原本的感知（Parser）和动作解析逻辑。
+    on_delta: 可选的 async 回调，传入时以流式生成，[SAY] 文本边生成边回调
+    priority: LLM 调度优先级；请求被取消或超时时抛出 LLMRequestCancelled
+    apply_actions: False 时只解析动作不写入房间，由调用方在多个角色都回复后统一用 resolve_action 执行
+    返回 (say 文本, 动作描述, NpcResponse)
     """
     from prompt_builder import build_prompt
     from roomAsyc import RoomSenseParser
     from room import add_role_to_room
-    import re, json
-    time_info = get_accelerated_time()
-    current_time_str = time_info["virtual_time"].strftime("%H:%M") # 例如 "08:30" 或 "23:15"
-    # 1. 实时感知
-    parser = RoomSenseParser(room.to_dict())
-    area_name, area_id = parser.get_area_name(role.x, role.y)
-    furnitures, doors = parser.get_room_details(area_id)
-    available_targets = furnitures + doors
-
-    # 获取完整的房间感知信息（改为使用已实现的 parse_for_role）
-    room_sense = parser.parse_for_role(role.name)
+    # 1. 实时感知（感知文本和当前区域的设施一次得到，位置未变时复用缓存）
+    parser = RoomSenseParser(room)
+    perception = parser.perceive(role.name)
+    if perception:
+        available_targets = perception.targets
+        room_sense = perception.text
+    else:
+        _, area_id = parser.get_area_name(role.x, role.y)
+        furnitures, doors = parser.get_room_details(area_id)
+        available_targets = furnitures + doors
+        room_sense = "找不到该角色。"
+    context_provider.update_room_sense(role.name, room_sense)
+    context = context_provider.get(role.name)
 
     # 2. 检索记忆
     memories = await asyncio.to_thread(query_memory, role.name, user_message, top_k=5)
@@ -511,59 +817,39 @@ async def handle_npc_response(role, user_message: str, room):
     # 直接访问属性，并确保在属性为 None 时返回空列表
     all_furnitures = [f.name for f in (room.layout.furniture or [])]
     all_doors = [d.name for d in (room.layout.doors or [])]
-    available_targets = all_furnitures + all_doors # 給予全域視野，防止 AI 找不到餐桌
+    # 給予全域視野，防止 AI 找不到餐桌；當前區域的設施排在前面，提示詞超出預算時優先保留
+    available_targets = list(dict.fromkeys(available_targets + all_furnitures + all_doors))
 
     # 3. 構造 Prompt
-    prompt = build_prompt(
+    # 按 token 预算压缩时需要分词，放到线程中执行
+    prompt = await asyncio.to_thread(
+        build_prompt,
         user_input=user_message,
         memories=memories,
         available_targets=available_targets,
-        room_sense=room_sense,
+        room_sense=context["room_sense"],
         role_name=role.name,
-        time_str=current_time_str  # <--- 這裡傳入時間
+        time_str=context["time_str"],  # <--- 這裡傳入時間，例如 "08:30" 或 "23:15"
+        rest_state=context["rest_state"]
     )
-    response_text = await asyncio.to_thread(run_ollama_sync, prompt)
-    print(f"AI 回复: {response_text}")
-    # 4. 解析动作
-    reply = response_text
-    # 如果 AI 固執地使用 /talk 格式，提取引號內的內容
-    talk_match = re.search(r'/talk\s*“([^”]+)”', reply)
-    if talk_match:
-        reply = talk_match.group(1)
-        
-    # 解析 JSON_START
+    # 4. 生成并一次性解析出 {thought, say, action, target}
+    site = "autonomous" if priority >= Priority.AUTONOMOUS else "reply"
+    if on_delta and STREAM_REPLIES:
+        response = await llm_scheduler.run(lambda: run_ollama_stream(prompt, on_delta, site=site), priority, role=role.name)
+    else:
+        # 只有自主行动等非对话调用使用回复缓存，对用户/NPC 的回复总是重新生成
+        text = await run_ollama(prompt, priority, role=role.name, cache=priority >= Priority.AUTONOMOUS, site=site)
+        response = parse_response(text)
+    print(f"AI 回复: {response.to_dict()}")
+
+    # 5. 执行动作
     action_status = None
-    json_match = re.search(r"JSON_START\s*(\{.*?\})\s*JSON_END", response_text, re.DOTALL)
-    match = json_match
-    if match:
-        try:
-            cmd = json.loads(match.group(1))
-            action = cmd.get("action")
-            # "move" 和 "talk_and_move" 都視為需要移動
-            if action in ["move", "talk_and_move"]:
-                target_name = cmd.get("target")
-                # 寻找目标坐标并更新数据库
-                found = False
-                if room.layout.furniture:
-                    for f in room.layout.furniture:
-                        if f.name == target_name:
-                            print(f"移动到家具: {target_name} at ({f.x}, {f.y})")
-                            await asyncio.to_thread(add_role_to_room, role.name, f.x, f.y, room.name)
-                            action_status = f"已移動到 {target_name}"
-                            found = True
-                            break
-                
-                # 如果家具沒找到，找門 (Doors)
-                if not found and room.layout.doors:
-                    for d in room.layout.doors:
-                        if d.name == target_name:
-                            await asyncio.to_thread(add_role_to_room, role.name, d.x, d.y, room.name)
-                            action_status = f"已穿過 {target_name}"
-                            break
-            # 清洗文本内容
-            reply = re.sub(r"JSON_START.*?JSON_END", "", response_text, flags=re.DOTALL).strip()
-        except Exception as e:
-            print(f"Action解析失败: {e}")
-
-    return reply, action_status,cmd
+    move = resolve_action(room, response)
+    if move:
+        x, y, action_status = move
+        print(f"{role.name} {action_status} at ({x}, {y})")
+        if apply_actions:
+            await asyncio.to_thread(add_role_to_room, role.name, x, y, room.name)
+
+    return response.say, action_status, response
 
@@ -0,0 +1,142 @@
+# metrics.py
+# 进程内指标（直方图/计数器），由 /metrics 以 Prometheus 文本格式导出，
+# 用于定位 NPC 延迟花在哪里（排队、预填充、生成、记忆检索、房间读写）
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 3072, 4096, 8192, 16384)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100, 200)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = labelnames
+        self.series: Dict[tuple, list] = {}  # key -> [每个桶的计数..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """计时一个代码块（秒）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                pairs = list(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _format_number(bound))])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_number(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(pairs)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets=LATENCY_BUCKETS,
+                  labelnames: Tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, help_text, buckets, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+# 单次 LLM 调用期间由后端填写的统计（prefill_tokens / output_tokens / ttft / thinking），
+# 由 ollama_client 中的 run_ollama* 在调用前设置、调用后汇总进直方图
+llm_call_stats: ContextVar[Optional[dict]] = ContextVar("llm_call_stats", default=None)
+
+# ---------- LLM 调用（site: reply / autonomous / narrative / consolidation） ----------
+LLM_CALLS = registry.counter("llm_calls_total", "LLM calls by call site and outcome", ("site", "status"))
+LLM_PROMPT_CHARS = registry.histogram("llm_prompt_chars", "Prompt length in characters", SIZE_BUCKETS, ("site",))
+LLM_PROMPT_TOKENS = registry.histogram("llm_prompt_tokens", "Prompt length in tokens (local tokenizer)",
+                                       SIZE_BUCKETS, ("site",))
+LLM_PREFILL_TOKENS = registry.histogram("llm_prefill_tokens", "Prompt tokens actually evaluated by the model "
+                                        "(excludes KV-cache prefix hits)", SIZE_BUCKETS, ("site",))
+LLM_QUEUE_WAIT = registry.histogram("llm_queue_wait_seconds", "Time spent waiting in the LLM scheduler queue",
+                                    LATENCY_BUCKETS, ("priority",))
+LLM_DROPPED = registry.counter("llm_requests_dropped_total", "Scheduled LLM requests cancelled or expired",
+                               ("priority", "reason"))
+LLM_TTFT = registry.histogram("llm_time_to_first_token_seconds", "Time to first output token",
+                              LATENCY_BUCKETS, ("site",))
+LLM_LATENCY = registry.histogram("llm_latency_seconds", "Total LLM call latency", LATENCY_BUCKETS, ("site",))
+LLM_TOKENS_PER_SEC = registry.histogram("llm_output_tokens_per_second", "Output generation rate",
+                                        RATE_BUCKETS, ("site",))
+LLM_THINKING_TOKENS = registry.counter("llm_thinking_tokens_discarded_total",
+                                       "Thinking tokens generated and stripped from the output", ("site",))
+
+# ---------- 记忆与房间 ----------
+MEMORY_QUERY = registry.histogram("memory_query_seconds", "query_memory latency", LATENCY_BUCKETS, ("mode",))
+ROOM_IO = registry.histogram("room_io_seconds", "Room state load/save latency", LATENCY_BUCKETS, ("op",))
+PERCEPTION_CACHE = registry.counter("perception_cache_total", "Role perception cache lookups", ("result",))
@@ -1,36 +1,222 @@
 # ollama_client.py
-import subprocess
+# 通过本地 Ollama HTTP API 调用模型：长连接池 + keep_alive 让模型常驻，带超时与重试。
+# 实际使用的后端由 config.LLM_BACKEND 选择（见 llm_backends.py）
+import asyncio
+import json
 import re
-from config import OLLAMA_MODEL
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+import httpx
+from config import (
+    OLLAMA_MODEL, OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE,
+    OLLAMA_TIMEOUT, OLLAMA_MAX_RETRIES, OLLAMA_MAX_CONNECTIONS,
+    LLM_BACKEND, FAKE_LLM_LATENCY, FAKE_LLM_TOKENS_PER_SEC, LLM_RECORD_PATH, LLM_REPLAY_STRICT
+)
+from response_stream import ResponseParser, NpcResponse
+from llm_cache import response_cache
+from llm_scheduler import llm_scheduler, Priority
+from llm_backends import FakeBackend, RecordingBackend, ReplayBackend
+from metrics import (
+    llm_call_stats, LLM_CALLS, LLM_LATENCY, LLM_PROMPT_CHARS, LLM_PROMPT_TOKENS, LLM_PREFILL_TOKENS,
+    LLM_TTFT, LLM_TOKENS_PER_SEC, LLM_THINKING_TOKENS
+)
+from token_counter import token_counter
 
-def run_ollama_sync(prompt: str) -> str:
-    """同步调用本地 ollama 模型"""
-    try:
-        # 增加 encoding='utf-8' 防止 Windows 下编码错误
-        result = subprocess.run(
-            ["ollama", "run", OLLAMA_MODEL],
-            input=prompt.encode("utf-8"),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True  # 增加 check=True 以便捕获错误
-        )
-        # 解析输出
-        output = result.stdout.decode("utf-8").strip()
-        
-        # ----------------------------------------------------
-        # 🔥 核心修復：使用正则删除思考过程，而不是只取最后一行
-        # ----------------------------------------------------
-        # 1. 匹配 Thinking... (换行) ...done thinking.
-        output = re.sub(r'Thinking\.\.\..*?\.\.\.done thinking\.', '', output, flags=re.DOTALL).strip()
-        
-        # 2. 兼容 DeepSeek/Qwen 等模型的 <think> 标签
-        output = re.sub(r'<think>.*?</think>', '', output, flags=re.DOTALL).strip()
-        
-        return output
-
-    except subprocess.CalledProcessError as e:
-        print(f"Ollama 调用失败: {e.stderr.decode('utf-8')}")
+# Thinking... (换行) ...done thinking. 以及 DeepSeek/Qwen 等模型的 <think> 标签，一次扫描删除
+_THINKING_RE = re.compile(r'Thinking\.\.\..*?\.\.\.done thinking\.|<think>.*?</think>', re.DOTALL)
+
+def strip_thinking(output: str) -> str:
+    """删除模型输出中的思考过程"""
+    return _THINKING_RE.sub('', output).strip()
+
+
+class OllamaClient:
+    """
+    Ollama /api/generate 客户端。所有调用共享一个 httpx.AsyncClient 连接池。
+    """
+    def __init__(self, base_url: str = OLLAMA_BASE_URL, model: str = OLLAMA_MODEL,
+                 keep_alive: str = OLLAMA_KEEP_ALIVE, timeout: float = OLLAMA_TIMEOUT,
+                 max_retries: int = OLLAMA_MAX_RETRIES, max_connections: int = OLLAMA_MAX_CONNECTIONS):
+        self.base_url = base_url
+        self.model = model
+        self.keep_alive = keep_alive
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.max_retries = max_retries
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _payload(self, prompt: str, stream: bool = False) -> dict:
+        return {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.keep_alive
+        }
+
+    def _should_retry(self, error: Exception) -> bool:
+        # 连接/超时错误和 5xx 重试，4xx（如模型不存在）直接失败
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+        return isinstance(error, httpx.TransportError)
+
+    def _backoff(self, attempt: int) -> float:
+        return 0.5 * (2 ** attempt)
+
+    def _record_stats(self, data: dict, raw: str = ""):
+        """把 Ollama 返回的计数与耗时记入本次调用的统计（仅在 run_ollama* 中调用时存在）"""
+        stats = llm_call_stats.get()
+        if stats is None:
+            return
+        stats["prefill_tokens"] = data.get("prompt_eval_count")
+        stats["output_tokens"] = data.get("eval_count")
+        if data.get("prompt_eval_duration") is not None:
+            # 模型加载 + 预填充完成即开始输出首个 token
+            stats["ttft"] = (data.get("load_duration", 0) + data["prompt_eval_duration"]) / 1e9
+        thinking = data.get("thinking", "") + "".join(_THINKING_RE.findall(raw))
+        if thinking:
+            stats["thinking"] = thinking
+
+    def _finish(self, data: dict) -> str:
+        raw = data.get("response", "")
+        self._record_stats(data, raw)
+        return strip_thinking(raw)
+
+    # ---------- 异步 ----------
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        return self._async_client
+
+    async def generate(self, prompt: str) -> str:
+        client = self._get_async_client()
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await client.post("/api/generate", json=self._payload(prompt))
+                response.raise_for_status()
+                return self._finish(response.json())
+            except Exception as e:
+                if attempt < self.max_retries and self._should_retry(e):
+                    print(f"Ollama 调用失败，重试 ({attempt + 1}/{self.max_retries}): {e}")
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                print(f"Ollama 调用失败: {e}")
+                return ""
         return ""
-    except Exception as e:
-        print(f"发生未知错误: {str(e)}")
-        return ""
\ No newline at end of file
+
+    async def generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        """流式生成，逐块产出原始文本（含思考内容，由调用方过滤）。只在收到首个 token 前重试"""
+        client = self._get_async_client()
+        for attempt in range(self.max_retries + 1):
+            started = False
+            try:
+                async with client.stream("POST", "/api/generate", json=self._payload(prompt, stream=True)) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.strip():
+                            continue
+                        data = json.loads(line)
+                        chunk = data.get("response", "")
+                        if chunk:
+                            started = True
+                            yield chunk
+                        if data.get("done"):
+                            self._record_stats(data)
+                            break
+                return
+            except Exception as e:
+                if not started and attempt < self.max_retries and self._should_retry(e):
+                    print(f"Ollama 流式调用失败，重试 ({attempt + 1}/{self.max_retries}): {e}")
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                print(f"Ollama 流式调用失败: {e}")
+                return
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+def create_backend(name: str = LLM_BACKEND):
+    """按 config.LLM_BACKEND 创建后端：ollama（真实模型）、fake（模拟延迟）、record（调用模型并录制）、replay（回放录制）"""
+    if name == "fake":
+        return FakeBackend(FAKE_LLM_LATENCY, FAKE_LLM_TOKENS_PER_SEC)
+    if name == "record":
+        return RecordingBackend(OllamaClient(), LLM_RECORD_PATH)
+    if name == "replay":
+        return ReplayBackend(LLM_RECORD_PATH, strict=LLM_REPLAY_STRICT)
+    return OllamaClient()
+
+llm_backend = create_backend()
+
+def _observe_call(site: str, prompt: str, stats: dict, started: float, output: str, status: str):
+    """把一次调用的统计汇总进 metrics 直方图"""
+    latency = time.monotonic() - started
+    LLM_CALLS.inc(site=site, status=status)
+    LLM_LATENCY.observe(latency, site=site)
+    LLM_PROMPT_CHARS.observe(len(prompt), site=site)
+    LLM_PROMPT_TOKENS.observe(token_counter.count(prompt), site=site)
+    if stats.get("prefill_tokens") is not None:
+        LLM_PREFILL_TOKENS.observe(stats["prefill_tokens"], site=site)
+    ttft = stats.get("ttft")
+    if ttft is not None:
+        LLM_TTFT.observe(ttft, site=site)
+    output_tokens = stats.get("output_tokens") or token_counter.count(output)
+    generation_time = latency - (ttft or 0)
+    if output_tokens and generation_time > 0:
+        LLM_TOKENS_PER_SEC.observe(output_tokens / generation_time, site=site)
+    if stats.get("thinking"):
+        LLM_THINKING_TOKENS.inc(token_counter.count(stats["thinking"]), site=site)
+
+async def _generate(prompt: str, site: str) -> str:
+    stats, started, response, status = {}, time.monotonic(), "", "cancelled"
+    token = llm_call_stats.set(stats)
+    try:
+        response = await llm_backend.generate(prompt)
+        status = "ok" if response else "error"
+    finally:
+        llm_call_stats.reset(token)
+        _observe_call(site, prompt, stats, started, response, status)
+    return response
+
+async def run_ollama(prompt: str, priority: Priority, role: Optional[str] = None,
+                     cache: bool = True, site: str = "other") -> str:
+    """
+    经 LLM 调度器排队调用本地模型。启用缓存时先查回复缓存，命中直接返回、不进入队列；
+    cache=False 时跳过回复缓存（面向用户的对话）。site 为指标中的调用方。
+    请求被取消或超时时抛出 LLMRequestCancelled
+    """
+    if cache:
+        cached = response_cache.get(prompt)
+        if cached is not None:
+            LLM_CALLS.inc(site=site, status="cache_hit")
+            return cached
+    response = await llm_scheduler.run(lambda: _generate(prompt, site), priority, role=role)
+    if cache:
+        response_cache.put(prompt, response)
+    return response
+
+async def run_ollama_stream(prompt: str, on_delta: Callable[[str], Awaitable[None]], site: str = "reply") -> NpcResponse:
+    """流式调用（面向用户，不走缓存）：可见的 [SAY] 文本通过 on_delta 实时回调，返回边接收边解析出的 NpcResponse"""
+    parser = ResponseParser()
+    stats, started, chunks, status = {}, time.monotonic(), [], "cancelled"
+    token = llm_call_stats.set(stats)
+    try:
+        async for chunk in llm_backend.generate_stream(prompt):
+            if not chunks:
+                first_token = time.monotonic() - started
+            chunks.append(chunk)
+            delta = parser.feed(chunk)
+            if delta:
+                await on_delta(delta)
+        tail = parser.finish()
+        if tail:
+            await on_delta(tail)
+        status = "ok" if chunks else "error"
+    finally:
+        llm_call_stats.reset(token)
+        if chunks:
+            stats["ttft"] = first_token  # 流式调用以实际收到首个片段的时间为准
+        if parser.thinking:
+            stats["thinking"] = parser.thinking
+        _observe_call(site, prompt, stats, started, "".join(chunks), status)
+    return parser.result()
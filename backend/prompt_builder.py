@@ -1,5 +1,11 @@
 # prompt_builder.py
-from typing import List, Dict
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional
+from config import PROMPT_LAYOUT, PROMPT_TOKEN_BUDGET
+from token_counter import token_counter
 
 def format_memories(memories: list) -> str:
     if not memories:
@@ -15,13 +21,200 @@ def format_memories(memories: list) -> str:
             formatted_list.append(f"[{m_type}]: {content}")
     return "\n".join(formatted_list)
 
+# 按稳定性分组排序记忆：设定类最稳定，其次是笔记、摘要，其余普通记忆在最后。
+# 组内按该角色的记忆首次进入提示词的顺序排列，新召回的记忆追加在所在分组末尾；
+# 普通记忆通常追加在整个记忆段末尾，新的设定/笔记/摘要或掉出召回的记忆仍会使其后的前缀失效
+MEMORY_STABILITY_ORDER = {"role_setup": 0, "system": 1, "note": 2, "summary": 3}
+MEMORY_ORDER_MAX_IDS = 1024  # 每个角色记住首次出现顺序的记忆条数上限
+IDENTITY_MEMORY_TYPES = ("role_setup", "system")
+EXCLUDED_MEMORY_TYPES = ("room_state",)
+
+# token 预算分配：固定部分之外，环境感知和设施列表最多占剩余预算的比例，其余给记忆
+ROOM_SENSE_BUDGET_SHARE = 0.3
+TARGETS_BUDGET_SHARE = 0.15
+MIN_TRUNCATED_MEMORY_TOKENS = 24
+
+# 与角色无关的固定规则，放在最前面，所有角色共享同一段前缀
+OUTPUT_RULES = """### 你的思考決策流程
+1. **[THOUGHT] 內心戲**：
+   - 判斷狀態：現在時間點我該做什麼？我累嗎？餓嗎？
+   - 判斷社交：用戶說的話我感興趣嗎？我現在的動作會被打斷嗎？
+   - 判斷行動：我需要移動去某個設施嗎？還是原地說話？
+   
+2. **[SAY] 公開對話**：
+   - 基於思考後的結果。包含說的話和**括號內的神態動作**（例：(打哈欠)、(邊走邊說)）。
+   - **禁止**在此出現「已移動到」等系統格式化文字。
+
+3. **JSON 指令**：
+   - `action`: "none", "move", "talk_and_move"
+   - `target`: 目標設施名稱。只有真正決定「出發」時才填寫。
+
+### 輸出規範
+必须遵守以下格式：
+[THOUGHT] (你的內心OS)
+[SAY] (你的實際回覆)
+JSON_START {"action": "...", "target": "..."} JSON_END
+
+### 範例：提議去廚房但「還沒出發」
+[THOUGHT] 肚子有點餓了，用戶提到了吃飯。我先問問他要不要一起去，如果他同意，我下一輪再出發。
+[SAY] (摸摸肚子) 好像是有點餓了呢。廚房裡還有食材，我們要不要一起去看看？
+JSON_START {"action": "none", "target": ""} JSON_END
+"""
+
+class FirstSeenOrder:
+    """记录每个角色的记忆首次进入提示词的顺序（超出上限时忘掉最早的）"""
+    def __init__(self, max_ids: int = MEMORY_ORDER_MAX_IDS):
+        self.max_ids = max_ids
+        self.roles: Dict[str, OrderedDict] = {}
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def rank(self, role_name: str, memory_keys: list) -> Dict[str, int]:
+        with self.lock:
+            seen = self.roles.setdefault(role_name, OrderedDict())
+            for memory_key in memory_keys:
+                if memory_key not in seen:
+                    seen[memory_key] = next(self.seq)
+            ranks = {memory_key: seen[memory_key] for memory_key in memory_keys}
+            while len(seen) > self.max_ids:
+                seen.popitem(last=False)
+            return ranks
+
+first_seen_order = FirstSeenOrder()
+
+def _memory_key(mem) -> str:
+    return mem.get("id") or mem.get("content", "")
+
+def sort_memories_by_stability(memories: list, role_name: Optional[str] = None) -> list:
+    """按稳定性分组；给出 role_name 时组内按首次出现顺序，否则按创建时间"""
+    ranks = first_seen_order.rank(role_name, [_memory_key(m) for m in memories]) if role_name else {}
+
+    def key(mem):
+        metadata = mem.get("metadata", {})
+        order = MEMORY_STABILITY_ORDER.get(metadata.get("type"), len(MEMORY_STABILITY_ORDER))
+        return (order, ranks.get(_memory_key(mem), 0), metadata.get("created_at", ""), mem.get("id", ""))
+    return sorted(memories, key=key)
+
+def _memory_type(mem) -> str:
+    return mem.get("metadata", {}).get("type", "memory")
+
+def compact_to_budget(budget: int, fixed_tokens: int, memories: list, available_targets: list, room_sense: str):
+    """
+    按优先级分配 token 预算：固定部分（规则、身份、时间、事件）必保留，
+    其后依次是环境感知、周边设施、记忆。记忆按检索排名（设定类优先）保留，
+    最低价值的先丢弃，预算边界上的那一条截断
+    """
+    remaining = max(0, budget - fixed_tokens)
+
+    room_sense = token_counter.truncate(room_sense, int(remaining * ROOM_SENSE_BUDGET_SHARE))
+    remaining -= token_counter.count(room_sense)
+
+    # 设施列表调用方已按距离排好（当前区域优先）
+    targets, cap, used = [], int(remaining * TARGETS_BUDGET_SHARE), 0
+    for target in available_targets:
+        cost = token_counter.count(target) + 1
+        if used + cost > cap:
+            break
+        targets.append(target)
+        used += cost
+    remaining -= used
+
+    ranked = ([m for m in memories if _memory_type(m) in IDENTITY_MEMORY_TYPES] +
+              [m for m in memories if _memory_type(m) not in IDENTITY_MEMORY_TYPES])
+    kept = []
+    for mem in ranked:
+        cost = token_counter.count(format_memories([mem])) + 1
+        if cost <= remaining:
+            kept.append(mem)
+            remaining -= cost
+            continue
+        overhead = cost - token_counter.count(mem.get("content", ""))
+        if remaining - overhead >= MIN_TRUNCATED_MEMORY_TOKENS:
+            kept.append({**mem, "content": token_counter.truncate(mem.get("content", ""), remaining - overhead)})
+        break
+    return kept, targets, room_sense
+
 def build_prompt(
     user_input: str,
     memories: list,
     available_targets: list,
     room_sense: str = "",
     role_name: str = "yui",
-    time_str: str = "未知時間"
+    time_str: str = "未知時間",
+    rest_state: str = "清醒",
+    layout: str = PROMPT_LAYOUT,
+    token_budget: Optional[int] = PROMPT_TOKEN_BUDGET
+) -> str:
+    """
+    layout="cache"：从最稳定到最易变排列（规则 -> 身份与设定记忆 -> 其余记忆 -> 设施 -> 时间/状态/环境 -> 事件），
+    相邻两轮的提示词共享尽可能长的前缀，Ollama 可以复用已缓存的 KV，只预填充变化的尾部。
+    layout="classic"：原来的排列方式
+    token_budget：提示词的 token 上限，超出时按优先级压缩环境、设施和记忆；None 表示不限
+    """
+    # 房间原始 JSON 永远不进入提示词
+    memories = [m for m in memories if _memory_type(m) not in EXCLUDED_MEMORY_TYPES]
+    render = build_classic_prompt if layout == "classic" else build_cached_prompt
+    if not token_budget:
+        return render(user_input, memories, available_targets, room_sense, role_name, time_str, rest_state)
+
+    fixed_tokens = token_counter.count(render(user_input, [], [], "", role_name, time_str, rest_state))
+    kept, targets, room_sense = compact_to_budget(token_budget, fixed_tokens, memories, available_targets, room_sense)
+    prompt = render(user_input, kept, targets, room_sense, role_name, time_str, rest_state)
+    print(f"[{role_name}] 提示词 {token_counter.count(prompt)} tokens（预算 {token_budget}）"
+          f" 记忆 {len(kept)}/{len(memories)} 设施 {len(targets)}/{len(available_targets)}")
+    return prompt
+
+def build_cached_prompt(
+    user_input: str,
+    memories: list,
+    available_targets: list,
+    room_sense: str = "",
+    role_name: str = "yui",
+    time_str: str = "未知時間",
+    rest_state: str = "清醒"
+) -> str:
+    targets_str = "、".join(available_targets) if available_targets else "無"
+    ordered = sort_memories_by_stability(memories, role_name)
+    identity_memories = [m for m in ordered if m.get("metadata", {}).get("type") in IDENTITY_MEMORY_TYPES]
+    other_memories = [m for m in ordered if m.get("metadata", {}).get("type") not in IDENTITY_MEMORY_TYPES]
+
+    identity_section = f"你是 {role_name}。你是一個真實生活在這裡的人。你有生理需求、情緒、和生活作息。"
+    if identity_memories:
+        identity_section += "\n" + format_memories(identity_memories)
+
+    if user_input and user_input.strip():
+        event_description = f"突發事件：用戶對你說：「{user_input}」"
+    else:
+        event_description = "當前狀況：周圍暫無人與你對話，你可以依照自己的意願行動。"
+
+    return f"""{OUTPUT_RULES}
+### 核心身份定義
+{identity_section}
+
+### 你的記憶流
+{format_memories(other_memories)}
+
+### 周邊設施
+🪑 {targets_str}
+
+### 當前時空背景
+⏰ **現在時間**：{time_str}
+😴 **身體狀態**：{rest_state}
+📍 **環境感知**：{room_sense}
+
+### 當前事件
+{event_description}
+
+請開始你的回覆："""
+
+def build_classic_prompt(
+    user_input: str,
+    memories: list,
+    available_targets: list,
+    room_sense: str = "",
+    role_name: str = "yui",
+    time_str: str = "未知時間",
+    rest_state: str = "清醒"
 ) -> str:
     targets_str = "、".join(available_targets) if available_targets else "無"
     memory_section = format_memories(memories)
@@ -37,6 +230,7 @@ def build_prompt(
 
 ### 當前時空背景
 ⏰ **現在時間**：{time_str}
+😴 **身體狀態**：{rest_state}
 📍 **環境感知**：{room_sense}
 🪑 **周邊設施**：{targets_str}
 
@@ -72,27 +266,21 @@ JSON_START {{"action": "none", "target": ""}} JSON_END
     return prompt
 
 # memory_manager.py
-def generate_world_narrative(role_name):
+async def generate_world_narrative(role_name):
     """
-    由神视角 AI 生成针对特定 NPC 的旁白感知
+    由神视角 AI 生成针对特定 NPC 的旁白感知（以最低的前台优先级排队）
     """
     # 局部导入，防止循环依赖
     from roomAsyc import RoomSenseParser
     from room import get_room
     from memory_manager import add_memory
-    from ollama_client import run_ollama_sync
+    from ollama_client import run_ollama
+    from llm_scheduler import Priority, LLMRequestCancelled
     from time_manager import get_accelerated_time
 
-    # 1. 获取并处理房间数据
-    room_obj = get_room()
-    
-    # 🔥 核心修复：将 Pydantic 对象转换为字典，确保 RoomSenseParser 的 .get() 方法可用
-    if hasattr(room_obj, "model_dump"):
-        room_data = room_obj.model_dump()
-    else:
-        room_data = room_obj.dict()
-
-    parser = RoomSenseParser(room_data)
+    # 1. 获取房间数据（RoomSenseParser 直接读取 Room 模型，布局索引按版本复用）
+    room_obj = await asyncio.to_thread(get_room)
+    parser = RoomSenseParser(room_obj)
     
     # 2. 获取该 NPC 的环境感知描述
     try:
@@ -124,13 +312,17 @@ def generate_world_narrative(role_name):
     """
     
     # 6. 调用本地 Ollama 生成旁白
-    narrative = run_ollama_sync(god_prompt)
+    try:
+        narrative = await run_ollama(god_prompt, Priority.NARRATIVE, role=role_name, site="narrative")
+    except LLMRequestCancelled as e:
+        print(f"[{role_name}] 神视角旁白跳过: {e}")
+        return None
     
     # 打印到控制台方便调试
     print(f"[{role_name}] 神视角旁白生成: {narrative}")
     
     if narrative:
         # 7. 将旁白作为特殊记忆类型存入，mtype="narrative"
-        add_memory(role_name, narrative, mtype="narrative")
+        await asyncio.to_thread(add_memory, role_name, narrative, "narrative")
         return narrative
     return None
\ No newline at end of file
@@ -0,0 +1,148 @@
+# response_stream.py
+# NPC 回复协议（[THOUGHT] / [SAY] / JSON_START ... JSON_END）的单遍解析：
+# 逐块接收模型输出（流式或完整文本），一次扫描得到 {thought, say, action, target}，
+# 丢弃 Thinking.../<think> 思考过程，流式时只放行 [SAY] 之后的可见文本
+import json
+import re
+from typing import Optional
+
+_TALK_RE = re.compile(r'/talk\s*[“"]([^”"]+)[”"]')
+_SYSTEM_NOTE_RE = re.compile(r'[（(]已(?:移動到|穿過).*?[）)]')
+_PAREN_RE = re.compile(r'[（(].*?[）)]')
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+_FIELD_RE = re.compile(r'["“\']?(action|target)["”\']?\s*[:：]\s*["“\']([^"”\']*)["”\']')
+_QUOTE_TABLE = str.maketrans({"“": '"', "”": '"', "‘": '"', "’": '"', "'": '"'})
+
+
+def recover_json(text: str) -> Optional[dict]:
+    """容错解析指令 JSON：截断、双大括号、中文引号、单引号、多余逗号，最后退回逐字段提取"""
+    start = text.find("{")
+    if start >= 0:
+        end = text.rfind("}")
+        candidate = text[start:end + 1] if end > start else text[start:] + "}"
+        for attempt in (candidate, _TRAILING_COMMA_RE.sub(r"\1", candidate.translate(_QUOTE_TABLE)
+                                                          .replace("{{", "{").replace("}}", "}"))):
+            try:
+                data = json.loads(attempt)
+                if isinstance(data, dict):
+                    return data
+            except ValueError:
+                pass
+    fields = dict(_FIELD_RE.findall(text))
+    return fields or None
+
+
+class NpcResponse:
+    """解析后的 NPC 回复，所有调用方共用同一个对象"""
+    def __init__(self, thought: str = "", say: str = "", action: str = "none", target: str = "",
+                 cmd: Optional[dict] = None):
+        self.thought = thought
+        self.say = say            # 公开对话，保留括号内的神态动作
+        self.action = action
+        self.target = target
+        self.cmd = cmd            # 原始指令 JSON（解析失败时为 None）
+
+    @property
+    def speech(self) -> str:
+        """去掉所有括号内容后的纯对话文本（作为说给别人的话）"""
+        return _PAREN_RE.sub("", self.say).strip()
+
+    def to_dict(self) -> dict:
+        return {"thought": self.thought, "say": self.say, "action": self.action, "target": self.target}
+
+
+class ResponseParser:
+    # 各状态下需要识别的标记 -> 进入的状态（None 表示回到进入前的状态）
+    TRANSITIONS = {
+        "preamble": {"[SAY]": "say", "[THOUGHT]": "thought", "JSON_START": "json",
+                     "<think>": "think", "Thinking...": "think"},
+        "thought": {"[SAY]": "say", "JSON_START": "json", "<think>": "think", "Thinking...": "think"},
+        "say": {"[THOUGHT]": "thought", "JSON_START": "json", "<think>": "think", "Thinking...": "think"},
+        "json": {"JSON_END": None},
+        "think": {"</think>": None, "...done thinking.": None},
+    }
+
+    def __init__(self):
+        self.state = "preamble"
+        self.resume_state = "preamble"
+        self.buffer = ""
+        self.parts = {"preamble": [], "thought": [], "say": [], "json": [], "think": []}
+        self.seen_say = False
+
+    def _holdback(self, markers) -> int:
+        """缓冲区末尾可能是某个标记前缀的长度，这部分先不输出"""
+        longest = 0
+        for marker in markers:
+            for size in range(min(len(marker) - 1, len(self.buffer)), longest, -1):
+                if self.buffer.endswith(marker[:size]):
+                    longest = size
+                    break
+        return longest
+
+    def _consume(self, text: str) -> str:
+        if text and self.state in self.parts:
+            self.parts[self.state].append(text)
+        return text if self.state == "say" else ""
+
+    def feed(self, chunk: str) -> str:
+        """输入一块模型输出，返回新增的可见 [SAY] 文本"""
+        self.buffer += chunk
+        visible = []
+        while True:
+            transitions = self.TRANSITIONS[self.state]
+            hits = [(self.buffer.find(m), m) for m in transitions if m in self.buffer]
+            if not hits:
+                break
+            index, marker = min(hits)
+            visible.append(self._consume(self.buffer[:index]))
+            self.buffer = self.buffer[index + len(marker):]
+            target = transitions[marker]
+            if target is None:
+                self.state = self.resume_state
+            else:
+                if target in ("json", "think"):
+                    self.resume_state = self.state
+                self.state = target
+                self.seen_say = self.seen_say or target == "say"
+
+        keep = self._holdback(self.TRANSITIONS[self.state])
+        ready = self.buffer[:len(self.buffer) - keep]
+        self.buffer = self.buffer[len(self.buffer) - keep:]
+        visible.append(self._consume(ready))
+        return "".join(visible)
+
+    def finish(self) -> str:
+        """流结束时输出缓冲区中剩余的可见文本"""
+        rest, self.buffer = self.buffer, ""
+        return self._consume(rest)
+
+    @property
+    def thinking(self) -> str:
+        """被丢弃的思考过程（Thinking.../<think> 内的文本）"""
+        return "".join(self.parts["think"])
+
+    def result(self) -> NpcResponse:
+        # 模型没有遵守格式（没有 [SAY]）时，把格式外的文本当作对话
+        say = "".join(self.parts["say"] if self.seen_say else self.parts["preamble"]).strip()
+        talk = _TALK_RE.search(say)
+        if talk:
+            say = talk.group(1)
+        say = _SYSTEM_NOTE_RE.sub("", say).strip()
+
+        json_text = "".join(self.parts["json"])
+        cmd = recover_json(json_text) if json_text.strip() else None
+        return NpcResponse(
+            thought="".join(self.parts["thought"]).strip(),
+            say=say,
+            action=str((cmd or {}).get("action") or "none"),
+            target=str((cmd or {}).get("target") or ""),
+            cmd=cmd
+        )
+
+
+def parse_response(text: str) -> NpcResponse:
+    """解析一段完整的模型输出"""
+    parser = ResponseParser()
+    parser.feed(text)
+    parser.finish()
+    return parser.result()
@@ -0,0 +1,166 @@
+# retention.py
+# 记忆保留策略：重要性随虚拟时间衰减（访问即强化），低价值记忆移入每个角色的冷归档
+# （gzip 压缩的 JSONL）。归档记忆不再出现在热向量索引中，但可以随时恢复。
+import asyncio
+import gzip
+import json
+import os
+import threading
+from typing import Dict, List
+import numpy as np
+
+from config import (
+    RETENTION_ENABLED, RETENTION_INTERVAL, RETENTION_HALF_LIFE_HOURS,
+    RETENTION_MIN_VALUE, RETENTION_MAX_HOT, MEMORY_ARCHIVE_DIR
+)
+from embedding_service import embedding_service
+from memory_columns import PINNED_MEMORY_TYPES
+from memory_manager import (
+    sanitize_name, memory_tier, get_or_create_collection, delete_memories, list_roles
+)
+from time_manager import get_accelerated_time
+
+
+class MemoryArchive:
+    """每个角色一个 gzip 压缩的 JSONL 冷归档文件"""
+    def __init__(self, archive_dir: str = MEMORY_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def path(self, role: str) -> str:
+        return os.path.join(self.archive_dir, f"{sanitize_name(role)}.jsonl.gz")
+
+    def append(self, role: str, mems: List[Dict], archived_at: str):
+        # gzip 支持多成员追加，读取时会依次解压
+        with self.lock, gzip.open(self.path(role), "at", encoding="utf-8") as f:
+            for mem in mems:
+                f.write(json.dumps({
+                    "id": mem["id"],
+                    "content": mem["content"],
+                    "metadata": mem["metadata"],
+                    "archived_at": archived_at
+                }, ensure_ascii=False) + "\n")
+
+    def _read(self, role: str) -> List[Dict]:
+        path = self.path(role)
+        if not os.path.exists(path):
+            return []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def load(self, role: str) -> List[Dict]:
+        with self.lock:
+            return self._read(role)
+
+    def take(self, role: str, memory_ids: List[str]) -> List[Dict]:
+        """从归档中取出指定记忆（会从归档文件中移除），写临时文件后原子替换"""
+        wanted = set(memory_ids)
+        with self.lock:
+            entries = self._read(role)
+            taken = [e for e in entries if e["id"] in wanted]
+            if not taken:
+                return []
+            path = self.path(role)
+            tmp_path = path + ".tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                for entry in entries:
+                    if entry["id"] not in wanted:
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, path)
+            return taken
+
+    def delete(self, role: str):
+        with self.lock:
+            path = self.path(role)
+            if os.path.exists(path):
+                os.remove(path)
+
+memory_archive = MemoryArchive()
+
+
+def select_evictions(role: str) -> List[Dict]:
+    """
+    选出需要归档的记忆：衰减后价值低于 RETENTION_MIN_VALUE 的，
+    以及热索引超过 RETENTION_MAX_HOT 时价值最低的那部分。身份类/时间记忆永不归档。
+    """
+    cols = memory_tier.get(role)
+    if cols is None or len(cols) == 0:
+        return []
+
+    now_ts = get_accelerated_time()["virtual_time"].timestamp()
+    with cols.lock:
+        value = cols.retention_value(now_ts, RETENTION_HALF_LIFE_HOURS)
+        evictable = ~cols.type_mask(PINNED_MEMORY_TYPES)
+        evict = evictable & (value < RETENTION_MIN_VALUE)
+
+        over = len(cols) - int(evict.sum()) - RETENTION_MAX_HOT
+        if over > 0:
+            rest = np.flatnonzero(evictable & ~evict)
+            evict[rest[np.argsort(value[rest], kind="stable")[:over]]] = True
+
+        return [cols.mems[row] for row in np.flatnonzero(evict)]
+
+
+def archive_role(role: str) -> int:
+    """把角色的低价值记忆移入冷归档，返回归档条数"""
+    mems = select_evictions(role)
+    if not mems:
+        return 0
+
+    memory_ids = [mem["id"] for mem in mems]
+    memory_archive.append(role, mems, get_accelerated_time()["iso_format"])
+    if not delete_memories(role, memory_ids):
+        # 没能从热索引删除时撤回归档，避免同一条记忆两边都有
+        memory_archive.take(role, memory_ids)
+        return 0
+
+    print(f"记忆归档 - 角色 {role}: 移入冷归档 {len(mems)} 条记忆")
+    return len(mems)
+
+
+def restore_memories(role: str, memory_ids: List[str]) -> int:
+    """从冷归档恢复记忆到热索引，返回恢复条数"""
+    entries = memory_archive.take(role, memory_ids)
+    if not entries:
+        return 0
+
+    now_ts = get_accelerated_time()["virtual_time"].timestamp()
+    mems = []
+    for entry in entries:
+        metadata = dict(entry["metadata"])
+        # 恢复视为一次访问，避免下一轮检查立刻又被归档
+        metadata["last_accessed_ts"] = now_ts
+        mems.append({"id": entry["id"], "content": entry["content"], "metadata": metadata})
+
+    try:
+        collection = get_or_create_collection(role)
+        collection.add(
+            ids=[mem["id"] for mem in mems],
+            documents=[mem["content"] for mem in mems],
+            metadatas=[mem["metadata"] for mem in mems],
+            embeddings=embedding_service.embed([mem["content"] for mem in mems])
+        )
+    except Exception as e:
+        print(f"恢复角色 {role} 的归档记忆失败: {e}")
+        # 写回归档，保持原来的归档时间
+        memory_archive.append(role, entries, entries[0].get("archived_at", ""))
+        return 0
+
+    memory_tier.put(role, mems)
+    print(f"记忆恢复 - 角色 {role}: 从冷归档恢复 {len(mems)} 条记忆")
+    return len(mems)
+
+
+async def retain_periodically(interval: float = RETENTION_INTERVAL):
+    """后台定时对所有角色执行保留策略"""
+    while True:
+        await asyncio.sleep(interval)
+        if not RETENTION_ENABLED:
+            continue
+        try:
+            roles = await asyncio.to_thread(list_roles)
+            for role in roles:
+                await asyncio.to_thread(archive_role, role)
+        except Exception as e:
+            print(f"记忆归档失败: {e}")
@@ -1,13 +1,17 @@
 # room.py
 import os
 import json
-from typing import List, Dict, Optional
+import threading
+from typing import List, Dict, Optional, Tuple
 from pydantic import BaseModel, Field
+from metrics import ROOM_IO
 
 # -----------------------
 # 配置
 # -----------------------
 ROOM_DIR = "room_data"
+ROOM_SAVE_DEBOUNCE = 1.0  # 房间变化后延迟写盘的秒数，期间的多次变化合并为一次写入
+ROLE_GRID_CELL = 100      # 角色位置空间哈希的格子边长（与最近的听觉半径一致）
 # 确保 room_data 文件夹存在
 os.makedirs(ROOM_DIR, exist_ok=True)
 
@@ -118,12 +122,233 @@ class Room(BaseModel):
         self.roles = [role for role in self.roles if role.name != role_name]
         
 # -----------------------
-# 房间管理函数 (CRUD)
+# 角色位置空间哈希
 # -----------------------
-# room.py
+class SpatialHash:
+    """按格子分桶的角色位置，半径查询只访问与查询圆相交的格子，用平方距离比较"""
+    def __init__(self, cell: int = ROLE_GRID_CELL):
+        self.cell = cell
+        self.cells: Dict[tuple, set] = {}
+        self.positions: Dict[str, tuple] = {}
 
-def get_room(room_name: str = "main") -> Room:
-    """读取房间对象，处理 Pydantic 转换和文件降级逻辑"""
+    def _key(self, x, y) -> tuple:
+        return (int(x // self.cell), int(y // self.cell))
+
+    def update(self, name: str, x, y):
+        old = self.positions.get(name)
+        if old is not None:
+            old_key = self._key(*old)
+            if old_key == self._key(x, y):
+                self.positions[name] = (x, y)
+                return
+            self._discard(name, old_key)
+        self.positions[name] = (x, y)
+        self.cells.setdefault(self._key(x, y), set()).add(name)
+
+    def _discard(self, name: str, key: tuple):
+        bucket = self.cells.get(key)
+        if bucket is not None:
+            bucket.discard(name)
+            if not bucket:
+                del self.cells[key]
+
+    def remove(self, name: str):
+        old = self.positions.pop(name, None)
+        if old is not None:
+            self._discard(name, self._key(*old))
+
+    def query(self, x, y, radius) -> List[tuple]:
+        """返回 [(角色名, x, y, 距离平方)]，包含距离不超过 radius 的所有角色"""
+        radius_sq = radius * radius
+        found = []
+        for cx in range(int((x - radius) // self.cell), int((x + radius) // self.cell) + 1):
+            for cy in range(int((y - radius) // self.cell), int((y + radius) // self.cell) + 1):
+                for name in self.cells.get((cx, cy), ()):
+                    px, py = self.positions[name]
+                    dist_sq = (px - x) ** 2 + (py - y) ** 2
+                    if dist_sq <= radius_sq:
+                        found.append((name, px, py, dist_sq))
+        return found
+
+    @classmethod
+    def build(cls, roles) -> "SpatialHash":
+        index = cls()
+        for role in roles:
+            index.update(role.name, role.x, role.y)
+        return index
+
+
+# -----------------------
+# 房间注册表（常驻内存 + 延迟原子写盘）
+# -----------------------
+class RoomStore:
+    """
+    进程内的房间注册表：每个房间只从磁盘加载一次，之后的读写都在内存中完成。
+    - version：房间每次变化（角色增删、移动、整体替换）都递增
+    - layout_version：静态布局变化时才递增（加载、整体替换），供空间索引等缓存判断是否需要重建
+    - 每个房间一把锁，角色按名字 O(1) 查找，位置另有空间哈希用于半径查询
+    - 写盘按 ROOM_SAVE_DEBOUNCE 合并，先写临时文件再 rename，拖动角色时不再每次读写整个文件；
+      每个房间的写盘由单独的保存锁串行化（快照到 rename 全程持有），已写盘的版本不会被旧快照覆盖
+    """
+    def __init__(self, debounce: float = ROOM_SAVE_DEBOUNCE):
+        self.debounce = debounce
+        self.rooms: Dict[str, Room] = {}
+        self.role_index: Dict[str, Dict[str, RoomRole]] = {}
+        self.spatial: Dict[str, SpatialHash] = {}
+        self.versions: Dict[str, int] = {}
+        self.layout_versions: Dict[str, int] = {}
+        self.locks: Dict[str, threading.RLock] = {}
+        self.timers: Dict[str, threading.Timer] = {}
+        self.save_locks: Dict[str, threading.Lock] = {}
+        self.saved_versions: Dict[str, int] = {}
+        self.registry_lock = threading.Lock()
+
+    def lock(self, room_name: str) -> threading.RLock:
+        with self.registry_lock:
+            return self.locks.setdefault(room_name, threading.RLock())
+
+    def _room(self, room_name: str) -> Room:
+        """返回内存中的房间对象（调用方需持有房间锁），首次访问时从磁盘加载"""
+        room = self.rooms.get(room_name)
+        if room is None:
+            with ROOM_IO.time(op="load"):
+                room = _load_room(room_name)
+            self._install(room_name, room)
+        return room
+
+    def _install(self, room_name: str, room: Room):
+        self.rooms[room_name] = room
+        self.role_index[room_name] = {role.name: role for role in room.roles}
+        self.spatial[room_name] = SpatialHash.build(room.roles)
+        self.versions[room_name] = self.versions.get(room_name, 0) + 1
+        self.layout_versions[room_name] = self.layout_versions.get(room_name, 0) + 1
+
+    def _changed(self, room_name: str):
+        self.versions[room_name] += 1
+        self._schedule_save(room_name)
+
+    def get(self, room_name: str = "main") -> Room:
+        """返回房间快照：角色列表为副本，静态布局与注册表共享（只读）"""
+        with self.lock(room_name):
+            room = self._room(room_name)
+            return room.model_copy(update={"roles": [role.model_copy() for role in room.roles]})
+
+    def snapshot(self, room_name: str = "main") -> Tuple[Room, int, int]:
+        """同一把锁下读取 (房间快照, 版本号, 布局版本号)，三者保证一致"""
+        with self.lock(room_name):
+            return self.get(room_name), self.versions[room_name], self.layout_versions[room_name]
+
+    def layout_version(self, room_name: str = "main") -> int:
+        with self.lock(room_name):
+            self._room(room_name)
+            return self.layout_versions[room_name]
+
+    def get_role(self, room_name: str, role_name: str) -> Optional[RoomRole]:
+        with self.lock(room_name):
+            self._room(room_name)
+            role = self.role_index[room_name].get(role_name)
+            return role.model_copy() if role else None
+
+    def roles_within(self, room_name: str, x, y, radius) -> List[tuple]:
+        """半径内的角色 [(角色名, x, y, 距离平方)]"""
+        with self.lock(room_name):
+            self._room(room_name)
+            return self.spatial[room_name].query(x, y, radius)
+
+    def upsert_role(self, room_name: str, role_name: str, x: int, y: int, avatar: str = "👤") -> int:
+        """添加或更新角色位置，返回新的版本号"""
+        with self.lock(room_name):
+            room = self._room(room_name)
+            role = self.role_index[room_name].get(role_name)
+            if role is None:
+                role = RoomRole(name=role_name, x=x, y=y, avatar=avatar)
+                room.roles.append(role)
+                self.role_index[room_name][role_name] = role
+            else:
+                role.x, role.y, role.avatar = x, y, avatar
+            self.spatial[room_name].update(role_name, x, y)
+            self._changed(room_name)
+            return self.versions[room_name]
+
+    def remove_role(self, room_name: str, role_name: str) -> int:
+        with self.lock(room_name):
+            room = self._room(room_name)
+            if self.role_index[room_name].pop(role_name, None) is not None:
+                room.roles = [role for role in room.roles if role.name != role_name]
+                self.spatial[room_name].remove(role_name)
+                self._changed(room_name)
+            return self.versions[room_name]
+
+    def keep_roles(self, room_name: str, predicate) -> int:
+        """只保留满足条件的角色"""
+        with self.lock(room_name):
+            room = self._room(room_name)
+            room.roles = [role for role in room.roles if predicate(role)]
+            self.role_index[room_name] = {role.name: role for role in room.roles}
+            self.spatial[room_name] = SpatialHash.build(room.roles)
+            self._changed(room_name)
+            return self.versions[room_name]
+
+    def replace(self, room_name: str, room: Room) -> int:
+        """整体替换房间（包括布局）"""
+        with self.lock(room_name):
+            self._install(room_name, room.model_copy(update={"roles": [r.model_copy() for r in room.roles]}))
+            self._schedule_save(room_name)
+            return self.versions[room_name]
+
+    # ---------- 持久化 ----------
+    def _schedule_save(self, room_name: str):
+        with self.registry_lock:
+            if room_name in self.timers:
+                return
+            timer = threading.Timer(self.debounce, self.flush, args=(room_name,))
+            timer.daemon = True
+            self.timers[room_name] = timer
+        timer.start()
+
+    def flush(self, room_name: str):
+        """立即把房间写盘（临时文件 + rename，写到一半崩溃也不会损坏原文件）"""
+        with self.registry_lock:
+            timer = self.timers.pop(room_name, None)
+            save_lock = self.save_locks.setdefault(room_name, threading.Lock())
+        if timer is not None:
+            timer.cancel()
+        # 保存锁只串行化写盘，不阻塞房间读写
+        with save_lock:
+            with self.lock(room_name):
+                room = self.rooms.get(room_name)
+                if room is None:
+                    return
+                version = self.versions[room_name]
+                data = room.to_dict()
+            if version <= self.saved_versions.get(room_name, 0):
+                return
+            with ROOM_IO.time(op="save"):
+                if _write_room_file(room_name, data):
+                    self.saved_versions[room_name] = version
+
+    def flush_all(self):
+        with self.registry_lock:
+            pending = list(self.timers)
+        for room_name in pending:
+            self.flush(room_name)
+
+
+def _write_room_file(room_name: str, data: dict) -> bool:
+    room_file = get_room_file_path(room_name)
+    tmp_file = f"{room_file}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, room_file)
+        return True
+    except Exception as e:
+        print(f"保存房间数据失败: {e}")
+        return False
+
+
+def _load_room(room_name: str) -> Room:
+    """从磁盘读取房间，处理 Pydantic 转换和文件降级逻辑"""
     room_file = get_room_file_path(room_name)
     
     # 1. 尝试从 room_data 文件夹读取
@@ -146,7 +371,7 @@ def get_room(room_name: str = "main") -> Room:
                 # 转换数据
                 room = Room.parse_obj(data)
                 # 自动将其保存到 room_data 文件夹，方便下次直接读取
-                save_room(room, room_name)
+                _write_room_file(room_name, room.to_dict())
                 return room
         except Exception as e:
             print(f"解析备份文件失败: {e}")
@@ -161,38 +386,46 @@ def get_room(room_name: str = "main") -> Room:
         walls=[]
     )
     return Room(name=room_name, layout=empty_layout)
+
+room_store = RoomStore()
+
+# -----------------------
+# 房间管理函数 (CRUD)
+# -----------------------
+# room.py
+
+def get_room(room_name: str = "main") -> Room:
+    """读取房间对象（内存快照）"""
+    return room_store.get(room_name)
+
+def get_room_snapshot(room_name: str = "main") -> Tuple[Room, int, int]:
+    """读取房间快照及其版本号、布局版本号"""
+    return room_store.snapshot(room_name)
+
+def get_layout_version(room_name: str = "main") -> int:
+    """房间静态布局的版本号，只在布局被加载或替换时递增"""
+    return room_store.layout_version(room_name)
+
+def find_roles_near(x, y, radius, room_name: str = "main") -> List[tuple]:
+    """查询 (x, y) 半径 radius 内的角色，返回 [(角色名, x, y, 距离平方)]"""
+    return room_store.roles_within(room_name, x, y, radius)
+
 def save_room(room: Room, room_name: str = "main"):
-    """保存房间对象"""
-    room_file = get_room_file_path(room_name)
-    try:
-        with open(room_file, "w", encoding="utf-8") as f:
-            json.dump(room.to_dict(), f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"保存房间数据失败: {e}")
+    """保存房间对象（替换内存中的房间，延迟写盘）"""
+    room_store.replace(room_name, room)
 
 def add_role_to_room(role_name: str, x: int, y: int, room_name: str = "main", avatar: str = "👤"):
     """添加或更新角色位置"""
-    room = get_room(room_name)
-    room.add_role(role_name, x, y, avatar)
-    save_room(room, room_name)
+    room_store.upsert_role(room_name, role_name, x, y, avatar)
 
 def remove_role_from_room(role_name: str, room_name: str = "main"):
     """从房间移除角色"""
-    room = get_room(room_name)
-    room.remove_role(role_name)
-    save_room(room, room_name)
+    room_store.remove_role(room_name, role_name)
     
 def clear_room(room_name: str = "main"):
     
     """清空房间中的所有非用户角色"""
-    room = get_room(room_name)
-    user_role = next((role for role in room.roles if role.name.lower() == 'user'), None)
-    
-    room.roles = []
-    if user_role:
-        room.roles.append(user_role)
-    
-    save_room(room, room_name)
+    room_store.keep_roles(room_name, lambda role: role.name.lower() == 'user')
     # room.py
 
 def execute_action(role_name: str, action_data: dict) -> str:
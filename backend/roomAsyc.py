@@ -1,63 +1,172 @@
 import math
+import threading
+
+from config import HEARING_RADIUS_NEAR, PERCEPTION_MAX_ROLES, PERCEPTION_RADIUS
+from metrics import PERCEPTION_CACHE
+
+LAYOUT_GRID_CELL = 64  # 区域网格索引的格子边长（坐标单位）
+
+
+def _field(obj, key, default=None):
+    """同时兼容 dict 和 Pydantic 模型的字段读取"""
+    if isinstance(obj, dict):
+        return obj.get(key, default)
+    return getattr(obj, key, default)
+
+
+class LayoutIndex:
+    """
+    静态布局的预编译索引：区域矩形按均匀网格分桶，坐标 -> 区域只检查所在格子里的候选；
+    区域 -> 家具/门 的列表预先算好。每个布局版本只构建一次
+    """
+    def __init__(self, layout, cell: int = LAYOUT_GRID_CELL):
+        self.cell = cell
+        self.areas = [
+            (_field(a, "name"), _field(a, "id"), _field(a, "x"), _field(a, "y"),
+             _field(a, "x") + _field(a, "width"), _field(a, "y") + _field(a, "height"))
+            for a in (_field(layout, "areas") or [])
+        ]
+        self.grid = {}
+        for i, (_, _, x1, y1, x2, y2) in enumerate(self.areas):
+            for cx in range(int(x1 // cell), int(x2 // cell) + 1):
+                for cy in range(int(y1 // cell), int(y2 // cell) + 1):
+                    # 按原始顺序追加，重叠区域时仍是第一个匹配的区域胜出
+                    self.grid.setdefault((cx, cy), []).append(i)
+
+        # 家具中心点落在区域矩形内即属于该区域；门按 area 字段归属
+        furniture = [(_field(f, "name"), _field(f, "x"), _field(f, "y")) for f in (_field(layout, "furniture") or [])]
+        doors = [(_field(d, "name"), _field(d, "area")) for d in (_field(layout, "doors") or [])]
+        self.details = {}
+        for _, area_id, x1, y1, x2, y2 in self.areas:
+            if area_id in self.details:
+                continue
+            self.details[area_id] = (
+                [name for name, fx, fy in furniture if x1 <= fx <= x2 and y1 <= fy <= y2],
+                [f"{name}" for name, door_area in doors if door_area == area_id]
+            )
+
+    def area_at(self, x, y):
+        for i in self.grid.get((int(x // self.cell), int(y // self.cell)), ()):
+            name, area_id, x1, y1, x2, y2 = self.areas[i]
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                return name, area_id
+        return "未知区域", None
+
+    def room_details(self, area_id):
+        furnitures, doors = self.details.get(area_id, ([], []))
+        return list(furnitures), list(doors)
+
+
+# 房间名 -> (布局版本, 布局对象, LayoutIndex)，只保留每个房间的最新版本
+_layout_indexes = {}
+_layout_lock = threading.Lock()
+
+def get_layout_index(room_name, layout_version, layout) -> LayoutIndex:
+    """按 (房间名, 布局版本) 复用已编译的布局索引"""
+    with _layout_lock:
+        cached = _layout_indexes.get(room_name)
+        if cached and cached[0] == layout_version and cached[1] is layout:
+            return cached[2]
+    index = LayoutIndex(layout)
+    with _layout_lock:
+        _layout_indexes[room_name] = (layout_version, layout, index)
+    return index
+
+
+class RolePerception:
+    """某个角色的环境感知结果：描述文本、所在区域及区域内的家具/门"""
+    def __init__(self, text, area_name, area_id, furnitures, doors):
+        self.text = text
+        self.area_name = area_name
+        self.area_id = area_id
+        self.furnitures = furnitures
+        self.doors = doors
+
+    @property
+    def targets(self):
+        """当前区域内可作为移动目标的家具和门"""
+        return list(self.furnitures) + list(self.doors)
+
+
+# 房间名 -> (布局版本, {角色名: (感知输入, RolePerception)})。感知输入包含自身位置和列出的
+# 周边人物位置，这些都没变时直接复用；布局版本变化时整个房间的缓存作废
+_perceptions = {}
+_perception_lock = threading.Lock()
+
 
 class RoomSenseParser:
-    def __init__(self, room_data):
-        # 🔥 如果传入的是 Pydantic 模型，自动转为字典
-        if hasattr(room_data, "model_dump"):
-            self.data = room_data.model_dump()
-        elif hasattr(room_data, "dict"):
-            self.data = room_data.dict()
-        else:
+    def __init__(self, room_data, layout_version=None):
+        """
+        room_data 可以是 Room 模型或其 dict。传入 Room 模型时布局不再转换为 dict，
+        布局索引按 (房间名, layout_version) 缓存；未提供版本时使用房间注册表中的当前版本
+        """
+        self.room_name = None
+        self.layout_version = None
+        if isinstance(room_data, dict):
             self.data = room_data
-            
-        # 确保使用字典访问
-        self.layout = self.data.get("layout", {})
+            self.layout = self.data.get("layout", {})
+            self.roles = [{"name": r["name"], "x": r["x"], "y": r["y"]} for r in self.data.get("roles", [])]
+            # dict 没有稳定的身份，按内容构建一次索引
+            self.index = LayoutIndex(self.layout)
+        else:
+            from room import get_layout_version
+            self.layout = room_data.layout
+            self.room_name = room_data.name
+            self.roles = [{"name": r.name, "x": r.x, "y": r.y} for r in room_data.roles]
+            if layout_version is None:
+                layout_version = get_layout_version(room_data.name)
+            self.layout_version = layout_version
+            self.index = get_layout_index(room_data.name, layout_version, self.layout)
+        self.roles_by_name = {r["name"]: r for r in self.roles}
 
     def get_distance(self, p1, p2):
         return math.sqrt((p1['x'] - p2['x'])**2 + (p1['y'] - p2['y'])**2)
 
     def get_area_name(self, x, y):
-        for area in self.layout.get("areas", []):
-            if area['x'] <= x <= area['x'] + area['width'] and \
-               area['y'] <= y <= area['y'] + area['height']:
-                return area['name'], area['id']
-        return "未知区域", None
+        return self.index.area_at(x, y)
 
     def get_room_details(self, area_id):
-        # 获取该房间内的家具
-        # 这里简化处理：判断家具中心点是否在房间矩形内
-        area = next((a for a in self.layout["areas"] if a["id"] == area_id), None)
-        if not area: return [], []
-
-        furnitures = []
-        for f in self.layout.get("furniture", []):
-            if area['x'] <= f['x'] <= area['x'] + area['width'] and \
-               area['y'] <= f['y'] <= area['y'] + area['height']:
-                furnitures.append(f['name'])
-
-        # 获取连接这个房间的门
-        doors = []
-        for d in self.layout.get("doors", []):
-            if d.get("area") == area_id:
-                doors.append(f"{d['name']}")
-                
-        return furnitures, doors
+        # 获取该房间内的家具与连接这个房间的门（预先算好的表）
+        return self.index.room_details(area_id)
 
-    def parse_for_role(self, role_name):
-        role = next((r for r in self.data["roles"] if r["name"] == role_name), None)
-        if not role: return "找不到该角色。"
+    def nearby_roles(self, role, radius):
+        """role 半径内的其他角色 [(角色 dict, 距离平方)]，房间模型走注册表的空间哈希"""
+        if self.room_name is not None:
+            from room import find_roles_near
+            found = find_roles_near(role["x"], role["y"], radius, self.room_name)
+            return [(self.roles_by_name[name], dist_sq) for name, _, _, dist_sq in found
+                    if name != role["name"] and name in self.roles_by_name]
+        radius_sq = radius * radius
+        found = []
+        for r in self.roles:
+            if r["name"] != role["name"]:
+                dist_sq = (r["x"] - role["x"]) ** 2 + (r["y"] - role["y"]) ** 2
+                if dist_sq <= radius_sq:
+                    found.append((r, dist_sq))
+        return found
 
+    def _nearby_for_perception(self, role):
+        """感知中列出的周边人物 [(角色 dict, 距离平方)] 及未列出的人数：人少时全部列出；人多时只列感知半径内最近的几位"""
+        if len(self.roles) - 1 <= PERCEPTION_MAX_ROLES:
+            candidates = [(r, (r["x"] - role["x"]) ** 2 + (r["y"] - role["y"]) ** 2)
+                          for r in self.roles if r["name"] != role["name"]]
+            return candidates, 0
+        near = sorted(self.nearby_roles(role, PERCEPTION_RADIUS), key=lambda c: c[1])
+        candidates = near[:PERCEPTION_MAX_ROLES]
+        return candidates, len(self.roles) - 1 - len(candidates)
+
+    def _build_perception(self, role, candidates, hidden) -> RolePerception:
         area_name, area_id = self.get_area_name(role['x'], role['y'])
         furnitures, doors = self.get_room_details(area_id)
-        
+
         # 寻找身边的其他人
         others = []
-        for r in self.data["roles"]:
-            if r["name"] != role_name:
-                dist = self.get_distance(role, r)
-                other_area, _ = self.get_area_name(r['x'], r['y'])
-                rel_pos = "就在你身边" if dist < 100 else f"距离你 {dist:.1f} 单位"
-                others.append(f"{r['name']}（在{other_area}，{rel_pos}）")
+        for r, dist_sq in candidates:
+            other_area, _ = self.get_area_name(r['x'], r['y'])
+            rel_pos = "就在你身边" if dist_sq < HEARING_RADIUS_NEAR ** 2 else f"距离你 {math.sqrt(dist_sq):.1f} 单位"
+            others.append(f"{r['name']}（在{other_area}，{rel_pos}）")
+        if hidden:
+            others.append(f"另有 {hidden} 人在更远处")
 
         # 组装描述文本
         desc = [
@@ -67,5 +176,38 @@ class RoomSenseParser:
             f"🚪 出口/门：{', '.join(doors) if doors else '没有明显的出口'}",
             f"👥 周边人物：{', '.join(others) if others else '附近没有其他人'}"
         ]
-        
-        return "\n".join(desc)
\ No newline at end of file
+
+        return RolePerception("\n".join(desc), area_name, area_id, furnitures, doors)
+
+    def perceive(self, role_name):
+        """
+        返回角色的 RolePerception，找不到角色时返回 None。
+        传入 Room 模型时按 (房间名, 布局版本, 自身及列出的周边人物位置) 缓存，无关角色移动不会使缓存失效
+        """
+        role = self.roles_by_name.get(role_name)
+        if not role:
+            return None
+        candidates, hidden = self._nearby_for_perception(role)
+        if self.room_name is None:
+            return self._build_perception(role, candidates, hidden)
+
+        key = (role["x"], role["y"], hidden, tuple((r["name"], r["x"], r["y"]) for r, _ in candidates))
+        with _perception_lock:
+            cached = _perceptions.get(self.room_name)
+            if cached and cached[0] == self.layout_version:
+                entry = cached[1].get(role_name)
+                if entry and entry[0] == key:
+                    PERCEPTION_CACHE.inc(result="hit")
+                    return entry[1]
+        PERCEPTION_CACHE.inc(result="miss")
+        perception = self._build_perception(role, candidates, hidden)
+        with _perception_lock:
+            cached = _perceptions.get(self.room_name)
+            if not cached or cached[0] != self.layout_version:
+                cached = _perceptions[self.room_name] = (self.layout_version, {})
+            cached[1][role_name] = (key, perception)
+        return perception
+
+    def parse_for_role(self, role_name):
+        perception = self.perceive(role_name)
+        return perception.text if perception else "找不到该角色。"
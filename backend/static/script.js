@@ -9,6 +9,7 @@ const roleSize = 60;
 let userName = document.getElementById("userNameInput").value;
 let userPosition = { x: 100, y: 100 };
 let roomData = null; 
+let awaitingSnapshot = false; // 已请求完整快照，收到前忽略增量
 let roomDimensions = { width: 800, height: 600 }; 
 
 let isDragging = false;
@@ -34,6 +35,7 @@ socket.on('disconnect', function () {
 
 socket.on('room_data_update', function (data) {
     roomData = data;
+    awaitingSnapshot = false;
     roomDimensions.width = roomData.width || 800;
     roomDimensions.height = roomData.height || 600;
     canvas.width = roomDimensions.width;
@@ -46,15 +48,52 @@ socket.on('room_data_update', function (data) {
     renderLayout(roomData.layout);
     renderRoles(roomData.roles);
 });
-// 在你的 socket 初始化代码处添加
-socket.on('room_update', function (data) {
-    console.log("收到地图更新指令");
-    roomData = data; // 更新全局 roomData
-    renderLayout(roomData.layout);
+// 增量更新：只包含变化的角色字段。版本号接不上（漏收或重连）时重新请求完整快照
+socket.on('room_delta', function (data) {
+    if (!roomData || awaitingSnapshot) return;
+    if (data.base_version !== roomData.version) {
+        awaitingSnapshot = true;
+        socket.emit('request_initial_data', { room_name: data.room_name });
+        return;
+    }
+    const removed = new Set(data.removed || []);
+    roomData.roles = roomData.roles.filter(r => !removed.has(r.name));
+    Object.entries(data.roles || {}).forEach(([name, fields]) => {
+        const role = roomData.roles.find(r => r.name === name);
+        if (role) {
+            Object.assign(role, fields);
+        } else {
+            roomData.roles.push(Object.assign({ name: name }, fields));
+        }
+    });
+    roomData.version = data.version;
     renderRoles(roomData.roles);
 });
+// 流式回复：先显示 [SAY] 片段，收到完整的 chat_message 后替换
+socket.on('chat_message_delta', function (data) {
+    let entry = document.getElementById(`stream-${data.message_id}`);
+    if (!entry) {
+        entry = document.createElement("p");
+        entry.id = `stream-${data.message_id}`;
+        entry.innerHTML = `<span class="log-time">(...)</span> <span class="log-ai">${data.sender}</span>: <span class="stream-text"></span>`;
+        chatLog.appendChild(entry);
+    }
+    entry.querySelector(".stream-text").textContent += data.delta;
+    chatLog.scrollTop = chatLog.scrollHeight;
+});
+
+// 回复被取消或生成失败：移除已显示的流式片段
+socket.on('chat_message_cancel', function (data) {
+    const streamed = document.getElementById(`stream-${data.message_id}`);
+    if (streamed) streamed.remove();
+});
+
 // script.js
 socket.on('chat_message', function (data) {
+    if (data.message_id) {
+        const streamed = document.getElementById(`stream-${data.message_id}`);
+        if (streamed) streamed.remove();
+    }
     let message = data.message;
     console.log(`收到聊天消息来自 ${data}: ${message}`);
     if (data.sender !== userName) {
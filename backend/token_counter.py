@@ -0,0 +1,72 @@
+# token_counter.py
+# 本地分词器计数：优先加载与模型一致的 HuggingFace tokenizer（本地 tokenizer.json 或 HF 缓存），
+# 加载失败时退回按字符估算（CJK 约 1 字 1 token，其余约 4 字符 1 token）
+import os
+import re
+import threading
+
+from config import PROMPT_TOKENIZER
+
+_CJK_RE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+class TokenCounter:
+    def __init__(self, tokenizer_name: str = PROMPT_TOKENIZER):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """加载分词器（只执行一次，启动时在线程中调用）"""
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not self.tokenizer_name:
+                return
+            try:
+                from tokenizers import Tokenizer
+                if os.path.exists(self.tokenizer_name):
+                    self.tokenizer = Tokenizer.from_file(self.tokenizer_name)
+                else:
+                    self.tokenizer = Tokenizer.from_pretrained(self.tokenizer_name)
+                print(f"分词器已加载: {self.tokenizer_name}")
+            except Exception as e:
+                print(f"分词器加载失败，改用字符估算: {e}")
+
+    def _estimate(self, text: str) -> int:
+        cjk = len(_CJK_RE.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        self.load()
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        return self._estimate(text)
+
+    def truncate(self, text: str, max_tokens: int, suffix: str = "…") -> str:
+        """截断到不超过 max_tokens 个 token（含省略号）"""
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        limit = max_tokens - self.count(suffix)
+        if limit <= 0:
+            return ""
+        if self.tokenizer is not None:
+            offsets = self.tokenizer.encode(text, add_special_tokens=False).offsets
+            return text[:offsets[limit - 1][1]] + suffix
+        # 估算模式：二分查找最长的前缀
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self._estimate(text[:mid]) <= limit:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low] + suffix
+
+token_counter = TokenCounter()